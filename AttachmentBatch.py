@@ -0,0 +1,434 @@
+'''AttachmentBatch - attaching many features at once, without the dialog.
+
+A spec tells how to attach one feature:
+    feature: name of the feature
+    refs: list of reference strings, as typed in attachment editor ("Box:Face1")
+    mode: attachment mode name, or "best" to use the best fit mode found by suggestModes
+    superplacement: [x, y, z, yaw, pitch, roll] (mm and degrees), or a Placement. Optional.
+    reverse: True to flip sides. Optional.
+Specs can be given as a list of dicts (or AttachmentSpec objects), or read from a
+JSON file (list of dicts, as above) or a CSV file (a header row with the field
+names; refs and superplacement are space-separated lists).
+
+Example (FreeCADCmd):
+import AttachmentBatch
+report = AttachmentBatch.attachAll(App.ActiveDocument, "datums.csv")
+AttachmentBatch.printReport(report)
+
+Specs don't depend on each other if none of the references of one spec is (or
+depends on) a feature of another spec. Independent specs are evaluated in
+parallel, by a pool of processes that each open a copy of the document. Dependent
+ones are evaluated afterwards, one by one, so that they see the new placements.
+
+The module also serves the attachment editor: serve() is the main loop of the
+process that evaluates previews of the dialog in background (see
+TaskAttachmentEditor.PreviewWorker).'''
+
+import base64
+import csv
+import json
+import os
+import pickle
+import sys
+import tempfile
+from collections import OrderedDict
+
+import FreeCAD as App
+
+from FrozenClass import FrozenClass
+from AttachmentLinks import LinkParser
+from DepGraphTools import getDepGraphIndex
+
+BEST_FIT = "best" # mode value that means "use the best fit mode"
+
+_PLACEMENT_TAG = "Placement" # first item of a superplacement tuple that holds Base + quaternion, see AttachmentSpec.toTuple
+_MESSAGE_TAG = "AttachmentPreview:" # prefix of lines of the preview worker protocol, see serve()
+
+STATUSattached = "Attached"
+STATUSnotAttached = "Not attached"
+STATUSerror = "Error"
+
+class AttachmentSpec(FrozenClass):
+    '''AttachmentSpec - how to attach one feature. See module docstring.'''
+
+    def __define_attributes(self):
+        self.feature = "" # name of the feature to attach
+        self.refs = [] # list of reference strings
+        self.mode = BEST_FIT
+        self.superplacement = None # [x, y, z, yaw, pitch, roll] (mm, deg), or Placement, or None (= keep the current one)
+        self.reverse = None # True/False, or None (= keep the current value)
+
+        self._freeze()
+
+    def __init__(self, feature, refs, mode = BEST_FIT, superplacement = None, reverse = None):
+        self.__define_attributes()
+
+        self.feature = feature
+        self.refs = list(refs)
+        self.mode = mode
+        self.superplacement = superplacement
+        self.reverse = reverse
+
+    def getSuperPlacement(self):
+        '''getSuperPlacement(): returns superplacement as App.Placement, or None if not specified.'''
+        plm = self.superplacement
+        if plm is None or isinstance(plm, App.Placement):
+            return plm
+        if len(plm) != 6:
+            raise ValueError("superplacement must have 6 numbers (x, y, z, yaw, pitch, roll), got {n}".format(n= len(plm)))
+        (x, y, z, yaw, pitch, roll) = [float(v) for v in plm]
+        return App.Placement(App.Vector(x, y, z), App.Rotation(yaw, pitch, roll))
+
+    def toTuple(self):
+        '''toTuple(): returns the spec as a tuple of plain values (to be sent to worker 
+        processes). makeSpec turns it back into the spec.'''
+        plm = self.superplacement
+        if isinstance(plm, App.Placement):
+            plm = (_PLACEMENT_TAG,) + tupleFromPlacement(plm)
+        return (self.feature, self.refs, self.mode, plm, self.reverse)
+
+def tupleFromPlacement(plm):
+    '''tupleFromPlacement(plm): returns (x, y, z, q0, q1, q2, q3) of App.Placement plm.'''
+    return tuple(plm.Base) + tuple(plm.Rotation.Q)
+
+def placementFromTuple(values):
+    '''placementFromTuple(values): inverse of tupleFromPlacement.'''
+    return App.Placement(App.Vector(*values[0:3]), App.Rotation(*values[3:7]))
+
+def _parseBool(value):
+    if value is None or isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value == "":
+        return None
+    if value in ("1", "true", "yes"):
+        return True
+    if value in ("0", "false", "no"):
+        return False
+    raise ValueError("Can't interpret {value} as a flag".format(value= repr(value)))
+
+def _split(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return str(value).split()
+
+def makeSpec(spec):
+    '''makeSpec(spec): makes AttachmentSpec from a dict (field names as keys) or a tuple
+    (fields in order feature, refs, mode, superplacement, reverse). AttachmentSpec is
+    returned as is.'''
+    if isinstance(spec, AttachmentSpec):
+        return spec
+    if isinstance(spec, dict):
+        if not spec.get("feature"):
+            raise ValueError("Spec {spec} has no feature".format(spec= repr(spec)))
+        spec = (spec["feature"], spec.get("refs"), spec.get("mode"), spec.get("superplacement"), spec.get("reverse"))
+    (feature, refs, mode, superplacement, reverse) = (list(spec) + [None]*5)[0:5]
+    if isinstance(superplacement, (list, tuple)) and len(superplacement) == 8 and superplacement[0] == _PLACEMENT_TAG:
+        superplacement = placementFromTuple(superplacement[1:])
+    elif not isinstance(superplacement, App.Placement):
+        superplacement = _split(superplacement)
+    return AttachmentSpec(str(feature),
+                          [str(ref) for ref in _split(refs)],
+                          mode= str(mode) if mode else BEST_FIT,
+                          superplacement= superplacement if superplacement else None,
+                          reverse= _parseBool(reverse))
+
+def readSpecs(filename):
+    '''readSpecs(filename): reads list of AttachmentSpec from a JSON or CSV file (by extension).'''
+    if os.path.splitext(filename)[1].lower() == ".json":
+        with open(filename) as f:
+            return [makeSpec(spec) for spec in json.load(f)]
+    with open(filename) as f:
+        return [makeSpec(row) for row in csv.DictReader(f)]
+
+def _makeAttacher(parser, spec):
+    '''_makeAttacher(parser, spec): returns (feature, attacher), attacher having 
+    parameters of the feature overridden by those of spec (except mode). parser is 
+    LinkParser of the document.'''
+    import Part
+    feat = parser.objects.get(spec.feature)
+    if feat is None:
+        raise ValueError("No object named {name}".format(name= spec.feature))
+    if not hasattr(feat, "AttacherType"):
+        raise ValueError("{feat} is not attachable".format(feat= feat.Name))
+    attacher = Part.AttachEngine(feat.AttacherType)
+    attacher.readParametersFromFeature(feat)
+    attacher.References = parser.parseList(spec.refs)
+    superplacement = spec.getSuperPlacement()
+    if superplacement is not None:
+        attacher.SuperPlacement = superplacement
+    if spec.reverse is not None:
+        attacher.Reverse = spec.reverse
+    return (feat, attacher)
+
+def _evaluateSpec(parser, spec):
+    '''_evaluateSpec(parser, spec): computes attachment of a feature, without changing
+    the document. Returns (attacher, placement); placement is None if not attached.'''
+    (feat, attacher) = _makeAttacher(parser, spec)
+    if spec.mode == BEST_FIT:
+        sugr = attacher.suggestModes()
+        if sugr["message"] == "LinkBroken":
+            raise ValueError("Failed to resolve links. {err}".format(err= sugr["error"]))
+        if sugr["message"] != "OK":
+            raise ValueError("No suitable attachment mode ({msg})".format(msg= sugr["message"]))
+        attacher.Mode = sugr["bestFitMode"]
+    else:
+        attacher.Mode = spec.mode
+    return (attacher, attacher.calculateAttachedPlacement(feat.Placement))
+
+def _evaluateToTuple(parser, spec):
+    '''runs _evaluateSpec, and returns the outcome as tuple of plain values:
+    (feature name, status, mode, placement tuple or None, message).'''
+    try:
+        (attacher, plm) = _evaluateSpec(parser, spec)
+    except Exception as err:
+        return (spec.feature, STATUSerror, None, None, getattr(err, "message", None) or str(err))
+    if plm is None:
+        return (spec.feature, STATUSnotAttached, attacher.Mode, None, "")
+    return (spec.feature, STATUSattached, attacher.Mode, tupleFromPlacement(plm), "")
+
+_worker_parsers = {} # dict. key = file name, value = LinkParser of the document opened by worker process
+
+def _workerEvaluate(args):
+    '''entry point of worker processes. args = (file name, list of spec tuples).'''
+    (filename, spec_tuples) = args
+    parser = _worker_parsers.get(filename)
+    if parser is None:
+        parser = LinkParser(App.openDocument(filename))
+        _worker_parsers[filename] = parser
+    return [_evaluateToTuple(parser, makeSpec(spec)) for spec in spec_tuples]
+
+def chooseMode(sugr, mode):
+    '''chooseMode(sugr, mode): keeps mode if it is applicable according to suggestor 
+    result sugr, otherwise picks the best fit one (if any). Same as what the attachment 
+    editor does when list of modes is refilled.'''
+    if mode in sugr["allApplicableModes"]:
+        return mode
+    if sugr["message"] == "OK":
+        return sugr["bestFitMode"]
+    return mode
+
+def evaluatePreviewJob(parser, job):
+    '''evaluatePreviewJob(parser, job): computes a preview of the attachment editor. 
+    job = (generation, spec tuple (see AttachmentSpec.toTuple), placement tuple of the 
+    feature, suggest). If suggest is true, suggestor is run, and the mode is chosen 
+    from its result (see chooseMode); otherwise mode of the spec is used. Returns 
+    (generation, suggestor result or None, mode, placement tuple or None, error 
+    message or None).'''
+    (generation, spec_tuple, placement, suggest) = job
+    spec = makeSpec(spec_tuple)
+    sugr = None
+    try:
+        (feat, attacher) = _makeAttacher(parser, spec)
+        attacher.Mode = spec.mode
+        if suggest:
+            result = attacher.suggestModes()
+            if result["message"] == "LinkBroken":
+                raise ValueError("Failed to resolve links. {err}".format(err= result["error"]))
+            sugr = result
+            attacher.Mode = chooseMode(sugr, spec.mode)
+        plm = attacher.calculateAttachedPlacement(placementFromTuple(placement))
+    except Exception as err:
+        return (generation, sugr, None, None, getattr(err, "message", None) or str(err))
+    return (generation, sugr, attacher.Mode, None if plm is None else tupleFromPlacement(plm), None)
+
+def encodeMessage(value):
+    '''encodeMessage(value): returns a line (without line end) of the preview worker 
+    protocol, carrying value (tuple of plain values).'''
+    return _MESSAGE_TAG + base64.b64encode(pickle.dumps(value, 2)).decode("ascii")
+
+def decodeMessage(line):
+    '''decodeMessage(line): returns value carried by a line of the preview worker 
+    protocol, or None if line is not a message (e.g. console output of FreeCAD).'''
+    line = line.strip()
+    if not line.startswith(_MESSAGE_TAG):
+        return None
+    return pickle.loads(base64.b64decode(line[len(_MESSAGE_TAG):].encode("ascii")))
+
+def serve(input = None, output = None):
+    '''serve(input = None, output = None): main loop of the preview worker process. Reads 
+    messages (file name of document copy, preview job) from input (stdin by default), 
+    and writes a message with the outcome of evaluatePreviewJob to output (stdout by 
+    default) for each. The document copy is opened on first use, and closed when a 
+    job names another file. Returns when input is closed.'''
+    if input is None:
+        input = sys.stdin
+    if output is None:
+        output = sys.__stdout__ #sys.stdout may be redirected to FreeCAD console
+    while True:
+        line = input.readline()
+        if not line:
+            break
+        message = decodeMessage(line)
+        if message is None:
+            continue
+        (filename, job) = message
+        for name in [name for name in _worker_parsers if name != filename]:
+            App.closeDocument(_worker_parsers.pop(name).document.Name)
+        try:
+            parser = _worker_parsers.get(filename)
+            if parser is None:
+                parser = LinkParser(App.openDocument(filename))
+                _worker_parsers[filename] = parser
+            outcome = evaluatePreviewJob(parser, job)
+        except Exception as err:
+            outcome = (job[0], None, None, None, getattr(err, "message", None) or str(err))
+        output.write(encodeMessage(outcome) + "\n")
+        output.flush()
+
+def _applyOutcome(parser, spec, outcome):
+    '''writes attachment of spec to the feature, given outcome of _evaluateToTuple.
+    Returns the report entry.'''
+    (name, status, mode, plm, message) = outcome
+    if status != STATUSerror:
+        try:
+            (feat, attacher) = _makeAttacher(parser, spec)
+            attacher.Mode = mode
+            attacher.writeParametersToFeature(feat)
+            if plm is not None:
+                feat.Placement = placementFromTuple(plm)
+        except Exception as err:
+            (status, message) = (STATUSerror, getattr(err, "message", None) or str(err))
+    return {"status": status, "mode": mode, "message": message}
+
+class SpecLoopError(ValueError):
+    '''SpecLoopError - raised by splitIndependent when specs depend on each other in a 
+    loop. Attributes independent and levels hold the specs that could be ordered anyway 
+    (same as splitIndependent returns), and stuck is the list of the rest: specs in 
+    loops, and specs that need them.'''
+    def __init__(self, independent, levels, stuck):
+        ValueError.__init__(self, "Attachment specs depend on each other in a loop: {names}"
+                                  .format(names= ", ".join([spec.feature for spec in stuck])))
+        self.independent = independent
+        self.levels = levels
+        self.stuck = stuck
+
+def splitIndependent(parser, specs):
+    '''splitIndependent(parser, specs): returns (independent, levels). independent is
+    the list of specs none of whose references is, or depends on, a feature of another
+    spec. The rest are split into levels (list of lists of specs): specs of a level
+    only need features of the independent specs and of earlier levels. Raises
+    SpecLoopError if specs depend on each other in a loop, and ValueError if there is
+    more than one spec for a feature. parser is LinkParser of the document.'''
+    index = getDepGraphIndex(parser.document)
+    features = set([spec.feature for spec in specs])
+    needs = OrderedDict() # key = feature name, value = set of names of spec features its references depend on
+    for spec in specs:
+        if spec.feature in needs:
+            raise ValueError("More than one spec for {name}".format(name= spec.feature))
+        needs[spec.feature] = set()
+        try:
+            refs = parser.parseList(spec.refs)
+        except ValueError:
+            continue #will be reported when evaluated
+        for (ref, subname) in refs:
+            reached = set(index.getDependenciesNames(ref))
+            reached.add(ref.Name)
+            needs[spec.feature] |= (reached & features) - set([spec.feature])
+    independent = [spec for spec in specs if len(needs[spec.feature]) == 0]
+    placed = set([spec.feature for spec in independent]) # features that come before the rest
+    rest = [spec for spec in specs if len(needs[spec.feature]) > 0]
+    levels = []
+    while len(rest) > 0:
+        ready = [spec for spec in rest if needs[spec.feature] <= placed]
+        if len(ready) == 0:
+            raise SpecLoopError(independent, levels, rest)
+        levels.append(ready)
+        placed |= set([spec.feature for spec in ready])
+        rest = [spec for spec in rest if not (spec.feature in placed)]
+    return (independent, levels)
+
+def attachAll(document, specs, processes = None, chunk_size = 50):
+    '''attachAll(document, specs, processes = None, chunk_size = 50): attaches features
+    according to specs (list, or name of JSON/CSV file; see module docstring).
+
+    processes: number of worker processes for independent specs. None means one per
+    CPU; 0 or 1 means do everything in this process. Defaults to 1 if GUI is up,
+    since forking FreeCAD GUI is not safe.
+
+    Returns OrderedDict, key = feature name, value = dict with keys "status"
+    (STATUSattached, STATUSnotAttached or STATUSerror), "mode" and "message". If more
+    than one spec is given for a feature, none of them is applied, and the feature is
+    reported as an error. Same for specs that depend on each other in a loop (and specs
+    that need them); the other specs are applied.
+    Document is recomputed only before each level of dependent specs (see
+    splitIndependent), so that their references are up to date.'''
+    if not isinstance(specs, (list, tuple)):
+        specs = readSpecs(specs)
+    specs = [makeSpec(spec) for spec in specs]
+    if processes is None:
+        if App.GuiUp:
+            processes = 1
+        else:
+            import multiprocessing
+            processes = multiprocessing.cpu_count()
+
+    report = OrderedDict([(spec.feature, None) for spec in specs])
+    counts = {}
+    for spec in specs:
+        counts[spec.feature] = counts.get(spec.feature, 0) + 1
+    for name in counts:
+        if counts[name] > 1:
+            report[name] = {"status": STATUSerror, "mode": None,
+                            "message": "{n} specs given for the same feature, none applied".format(n= counts[name])}
+    specs = [spec for spec in specs if counts[spec.feature] == 1]
+    parser = LinkParser(document) #attaching doesn't add or remove objects, so it stays valid throughout
+    try:
+        (independent, levels) = splitIndependent(parser, specs)
+    except SpecLoopError as err:
+        #specs that can be ordered are still attached
+        (independent, levels) = (err.independent, err.levels)
+        for spec in err.stuck:
+            report[spec.feature] = {"status": STATUSerror, "mode": None, "message": str(err)}
+
+    outcomes = None
+    if processes > 1 and len(independent) > chunk_size:
+        outcomes = _evaluateInPool(document, independent, processes, chunk_size)
+    if outcomes is None:
+        outcomes = [_evaluateToTuple(parser, spec) for spec in independent]
+    for (spec, outcome) in zip(independent, outcomes):
+        report[spec.feature] = _applyOutcome(parser, spec, outcome)
+
+    for level in levels:
+        #references depend on features attached just before, bring their shapes up to date
+        document.recompute()
+        for spec in level:
+            report[spec.feature] = _applyOutcome(parser, spec, _evaluateToTuple(parser, spec))
+    return report
+
+def _evaluateInPool(document, specs, processes, chunk_size):
+    '''evaluates specs on a process pool, on a copy of document saved to a temporary
+    file. Returns list of outcomes, or None if the pool couldn't be used.'''
+    import multiprocessing
+    (handle, filename) = tempfile.mkstemp(suffix= ".FCStd")
+    os.close(handle)
+    try:
+        document.saveCopy(filename)
+        chunks = [(filename, [spec.toTuple() for spec in specs[i:i+chunk_size]])
+                  for i in range(0, len(specs), chunk_size)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_workerEvaluate, chunks)
+        finally:
+            pool.close()
+            pool.join()
+        return [outcome for chunk in results for outcome in chunk]
+    except Exception as err:
+        App.Console.PrintWarning("AttachmentBatch: process pool failed ({err}), evaluating in this process.\n"
+                                 .format(err= err))
+        return None
+    finally:
+        os.remove(filename)
+
+def printReport(report):
+    '''printReport(report): prints errors from report returned by attachAll, then counts by status.'''
+    counts = OrderedDict([(STATUSattached, 0), (STATUSnotAttached, 0), (STATUSerror, 0)])
+    for name in report:
+        counts[report[name]["status"]] += 1
+    for name in report:
+        entry = report[name]
+        if entry["status"] == STATUSerror:
+            App.Console.PrintError("{name}: {msg}\n".format(name= name, msg= entry["message"]))
+    App.Console.PrintMessage(", ".join(["{status}: {n}".format(status= status, n= counts[status]) for status in counts]) + "\n")
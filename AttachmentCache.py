@@ -0,0 +1,272 @@
+from collections import OrderedDict
+
+from FrozenClass import FrozenClass
+import DocumentObserver
+from DepGraphTools import getContainerChain
+from AttachmentLinks import LinkFromStr, getTopologyIndex
+
+class SuggestorCache(FrozenClass):
+    '''SuggestorCache - LRU cache of AttachEngine.suggestModes() results. Key is the 
+    signature of the references: attacher type, object names, subelement names, and 
+    revision stamps of the referenced objects and of the containers they are in 
+    (see DocumentObserver.getObjectRevision). So any change to geometry or placement 
+    of a reference makes its old entries unreachable; they are evicted eventually.
+    
+    Use the shared instance via suggestModes(attacher).'''
+    
+    def __define_attributes(self):
+        self.entries = OrderedDict() # key = references signature, value = result of suggestModes. Most recently used last.
+        self.max_entries = 64
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uncacheable = 0 #number of calls that bypassed the cache (no document notifications)
+        
+        self._freeze()
+    
+    def __init__(self, max_entries = 64):
+        self.__define_attributes()
+        
+        self.max_entries = max_entries
+    
+    def getKey(self, attacher):
+        '''getKey(attacher): returns references signature of attacher, or None if it can't be made.'''
+        refs = []
+        for (obj, subname) in attacher.References:
+            rev = DocumentObserver.getObjectRevision(obj)
+            if rev is None:
+                return None
+            cnt_revs = tuple([DocumentObserver.getObjectRevision(cnt) for cnt in getContainerChain(obj)[1:]])
+            refs.append((obj.Document.Name, obj.Name, subname, rev, cnt_revs))
+        return (attacher.AttacherType, tuple(refs))
+    
+    def lookup(self, key):
+        '''lookup(key): returns cached suggestor result for references signature key (see 
+        getKey), or None if not cached. Counts a hit or a miss.'''
+        if key is None:
+            self.uncacheable += 1
+            return None
+        sugr = self.entries.pop(key, None)
+        if sugr is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = sugr #move to end (most recently used)
+        return sugr
+    
+    def store(self, key, sugr):
+        '''store(key, sugr): remembers suggestor result sugr for references signature key.'''
+        if key is None:
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = sugr
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last= False)
+            self.evictions += 1
+    
+    def suggestModes(self, attacher):
+        '''suggestModes(attacher): returns attacher.suggestModes(), from cache if possible. 
+        The returned dict is shared with the cache, don't modify it.'''
+        key = self.getKey(attacher)
+        sugr = self.lookup(key)
+        if sugr is None:
+            sugr = attacher.suggestModes()
+            self.store(key, sugr)
+        return sugr
+    
+    def getStats(self):
+        '''getStats(): returns dict with hit/miss statistics.'''
+        total = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "uncacheable": self.uncacheable,
+                "entries": len(self.entries),
+                "hit_rate": float(self.hits) / total if total > 0 else 0.0}
+    
+    def clear(self):
+        '''clear(): drops all entries and resets statistics.'''
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uncacheable = 0
+
+_suggestor_cache = SuggestorCache()
+
+def suggestModes(attacher):
+    '''suggestModes(attacher): memoized attacher.suggestModes(). See SuggestorCache.'''
+    return _suggestor_cache.suggestModes(attacher)
+
+def getSuggestorCache():
+    '''getSuggestorCache(): returns the shared SuggestorCache (e.g. for getStats()).'''
+    return _suggestor_cache
+
+class LinkCache(FrozenClass):
+    '''LinkCache - LRU cache of reference strings resolved into links (see 
+    AttachmentLinks.LinkFromStr). Key is (document name, string). Entries of a document 
+    are valid as long as its structure revision is the same (see 
+    DocumentObserver.getStructureRevision), i.e. names resolve to the same objects. So 
+    a reference line is resolved again only after it was edited, or after objects were 
+    added or removed. Strings that fail to resolve are not cached. Subelement names of 
+    cached links are checked again on every hit (see AttachmentLinks.TopologyIndex), 
+    since shapes may have changed.
+    
+    Use the shared instance via resolveLinks(strings, document).'''
+    
+    def __define_attributes(self):
+        self.entries = OrderedDict() # key = (document name, string), value = link tuple or None (empty string). Most recently used last.
+        self.revisions = {} # dict. key = document name, value = structure revision entries of the document were made at
+        self.max_entries = 256
+        self.hits = 0
+        self.misses = 0
+        
+        self._freeze()
+    
+    def __init__(self, max_entries = 256):
+        self.__define_attributes()
+        
+        self.max_entries = max_entries
+    
+    def resolve(self, strlink, document):
+        '''resolve(strlink, document): returns LinkFromStr(strlink, document), from cache if possible.'''
+        rev = DocumentObserver.getStructureRevision(document)
+        if rev is None:
+            return LinkFromStr(strlink, document)
+        if self.revisions.get(document.Name) != rev:
+            for key in [key for key in self.entries if key[0] == document.Name]:
+                del self.entries[key]
+            self.revisions[document.Name] = rev
+        key = (document.Name, strlink)
+        if key in self.entries:
+            self.hits += 1
+            lnk = self.entries.pop(key)
+            self.entries[key] = lnk #move to end (most recently used)
+            if lnk is not None:
+                getTopologyIndex().checkSubname(lnk[0], lnk[1])
+            return lnk
+        self.misses += 1
+        lnk = LinkFromStr(strlink, document)
+        self.entries[key] = lnk
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last= False)
+        return lnk
+    
+    def resolveList(self, strings, document):
+        '''resolveList(strings, document): same as AttachmentLinks.RefsFromStrList, via cache.'''
+        refs = []
+        for st in strings:
+            lnk = self.resolve(st, document)
+            if lnk is not None:
+                refs.append(lnk)
+        return refs
+    
+    def getStats(self):
+        '''getStats(): returns dict with cache statistics.'''
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+    
+    def clear(self):
+        '''clear(): drops all entries and resets statistics.'''
+        self.entries = OrderedDict()
+        self.revisions = {}
+        self.hits = 0
+        self.misses = 0
+
+_link_cache = LinkCache()
+
+def resolveLinks(strings, document):
+    '''resolveLinks(strings, document): same as AttachmentLinks.RefsFromStrList, but 
+    strings that were resolved before (and objects weren't added/removed since) are 
+    taken from the shared LinkCache.'''
+    return _link_cache.resolveList(strings, document)
+
+def getLinkCache():
+    '''getLinkCache(): returns the shared LinkCache.'''
+    return _link_cache
+
+class ModeCatalog(FrozenClass):
+    '''ModeCatalog - user-facing texts of attachment modes and reference types of one 
+    attacher type: mode names, tooltips, formatted reference combinations. The 
+    metadata is static, so each text is asked from the engine once (when first 
+    needed), and then kept for the rest of the session.
+    
+    Use getModeCatalog(attacher) to obtain the catalog for attacher's type.'''
+    
+    def __define_attributes(self):
+        self.attacher_type = None
+        self.engine = None #AttachEngine of attacher_type, used to query metadata
+        self.mode_names = {} # dict. key = mode, value = user-friendly name
+        self.mode_tooltips = {} # dict. key = mode, value = tooltip text (docu and reference combinations)
+        self.reachable_texts = {} # dict. key = (mode, tuple of tuples of ref types), value = list item text for a reachable mode
+        self.ref_type_names = {} # dict. key = ref type, value = user-friendly name
+        
+        self._freeze()
+    
+    def __init__(self, attacher_type, engine):
+        self.__define_attributes()
+        
+        self.attacher_type = attacher_type
+        self.engine = engine
+    
+    def getRefTypeName(self, ref_type):
+        '''getRefTypeName(ref_type): returns user-friendly name of reference type.'''
+        name = self.ref_type_names.get(ref_type)
+        if name is None:
+            name = self.engine.getRefTypeInfo(ref_type)["UserFriendlyName"]
+            self.ref_type_names[ref_type] = name
+        return name
+    
+    def getModeName(self, mode):
+        '''getModeName(mode): returns user-friendly name of attachment mode.'''
+        name = self.mode_names.get(mode)
+        if name is None:
+            name = self.engine.getModeInfo(mode)["UserFriendlyName"]
+            self.mode_names[mode] = name
+        return name
+    
+    def getModeTooltip(self, mode):
+        '''getModeTooltip(mode): returns tooltip for a list item of attachment mode.'''
+        tip = self.mode_tooltips.get(mode)
+        if tip is None:
+            mi = self.engine.getModeInfo(mode)
+            cmb = []
+            for refstr in mi["ReferenceCombinations"]:
+                refstr_userfriendly = [self.getRefTypeName(t) for t in refstr]
+                cmb.append(u", ".join(refstr_userfriendly))
+            tip = u"{docu}\n\nReference combinations:\n{combinations}".format(docu=mi["BriefDocu"], combinations= u"\n".join(cmb) )
+            self.mode_tooltips[mode] = tip
+        return tip
+    
+    def getReachableModeText(self, mode, listlistrefs):
+        '''getReachableModeText(mode, listlistrefs): returns list item text for a mode that 
+        becomes applicable if more references are added. listlistrefs is the value from 
+        suggestor result's "reachableModes" dict.'''
+        key = (mode, tuple([tuple(refs) for refs in listlistrefs]))
+        txt = self.reachable_texts.get(key)
+        if txt is None:
+            if len(listlistrefs) == 1:
+                listrefs_userfriendly = [self.getRefTypeName(t) for t in listlistrefs[0]]
+                txt = u"{mode} (add {morerefs})".format(mode= self.getModeName(mode), 
+                                                        morerefs= u"+".join(listrefs_userfriendly))
+            else:
+                txt = u"{mode} (add more references)".format(mode= self.getModeName(mode))
+            self.reachable_texts[key] = txt
+        return txt
+    
+    def prebuild(self):
+        '''prebuild(): fills in names and tooltips of all modes implemented by the attacher 
+        type, so that later lookups never hit the engine.'''
+        for mode in self.engine.ImplementedModes:
+            self.getModeName(mode)
+            self.getModeTooltip(mode)
+
+_catalogs = {} # dict. key = AttacherType, value = ModeCatalog
+
+def getModeCatalog(attacher):
+    '''getModeCatalog(attacher): returns ModeCatalog of attacher's type, creating it if necessary.'''
+    catalog = _catalogs.get(attacher.AttacherType)
+    if catalog is None:
+        import Part
+        catalog = ModeCatalog(attacher.AttacherType, Part.AttachEngine(attacher.AttacherType))
+        _catalogs[attacher.AttacherType] = catalog
+    return catalog
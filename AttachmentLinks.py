@@ -0,0 +1,173 @@
+'''AttachmentLinks - conversion between reference strings as typed in attachment 
+editor ("Object:SubElement") and links as stored in PropertyLinkSubList. No GUI 
+needed, so it can be used by scripts as well.'''
+
+import re
+
+from FrozenClass import FrozenClass
+import DocumentObserver
+
+ELEMENT_TYPES = ["Face", "Edge", "Vertex"]
+_element_lists = {"Face": "Faces", "Edge": "Edges", "Vertex": "Vertexes"} # attributes of Part.Shape listing the elements
+_re_element = re.compile("^(Face|Edge|Vertex)(.*)$")
+_named_subelements = {"Sketcher::SketchObject": ["H_Axis", "V_Axis", "RootPoint"]} # key = TypeId, value = subelement names other than Face/Edge/Vertex that objects of the type accept
+
+class TopologyIndex(FrozenClass):
+    '''TopologyIndex - numbers of faces, edges and vertices of shapes of objects, for 
+    checking subelement names without touching the shape. Entries are keyed by object 
+    revision (see DocumentObserver.getObjectRevision), so they are recounted after the 
+    object changes (e.g. is recomputed).
+    
+    Use the shared instance via getTopologyIndex().'''
+    
+    def __define_attributes(self):
+        self.entries = {} # dict. key = (document name, object name), value = (object revision, dict of counts by element type, or None if object has no shape)
+        self.caching = False #False if document notifications are unavailable. Then nothing is ever cached.
+        
+        self._freeze()
+    
+    def __init__(self):
+        self.__define_attributes()
+        
+        self.caching = DocumentObserver.addListener(self)
+    
+    def getCounts(self, obj):
+        '''getCounts(obj): returns dict (key = "Face"/"Edge"/"Vertex", value = number of 
+        such elements of obj.Shape), or None if obj has no shape.'''
+        key = (obj.Document.Name, obj.Name)
+        rev = DocumentObserver.getObjectRevision(obj) if self.caching else None
+        if rev is not None:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == rev:
+                return entry[1]
+        counts = _countElements(obj)
+        if rev is not None:
+            self.entries[key] = (rev, counts)
+        return counts
+    
+    def checkSubname(self, obj, subname):
+        '''checkSubname(obj, subname): raises ValueError if subname can't be a subelement of 
+        obj: a beginning of Face/Edge/Vertex (as while typing, e.g. "Fac"), a malformed or 
+        out of range Face/Edge/Vertex name, or, for objects with a shape, anything else 
+        except names listed in _named_subelements (like "H_Axis" of sketches). Empty 
+        subname is fine.'''
+        if subname == "":
+            return
+        match = _re_element.match(subname)
+        if match is None:
+            if any([element_type.startswith(subname) for element_type in ELEMENT_TYPES]):
+                raise ValueError("Incomplete subelement name {sub}".format(sub= subname))
+            if self.getCounts(obj) is None:
+                return #no shape, can't tell
+            for type_id in _named_subelements:
+                if subname in _named_subelements[type_id] and obj.isDerivedFrom(type_id):
+                    return
+            raise ValueError("{obj} has no subelement named {sub} (expected Face, Edge or Vertex followed by a number)"
+                             .format(obj= obj.Name, sub= subname))
+        (element_type, number) = match.groups()
+        if not (number.isdigit() and number[0] != "0"):
+            raise ValueError("Malformed subelement name {sub} (expected {type} followed by a number starting from 1)"
+                             .format(sub= subname, type= element_type))
+        counts = self.getCounts(obj)
+        if counts is None:
+            return #can't tell
+        if int(number) > counts[element_type]:
+            raise ValueError("{obj} has no {sub} (it has {n} {elements})"
+                             .format(obj= obj.Name, sub= subname, n= counts[element_type], elements= _element_lists[element_type]))
+    
+    #document notifications
+    def slotDeletedObject(self, obj):
+        self.entries.pop((obj.Document.Name, obj.Name), None)
+    
+    def slotDeletedDocument(self, doc):
+        for key in [key for key in self.entries if key[0] == doc.Name]:
+            del self.entries[key]
+
+def _countElements(obj):
+    shape = getattr(obj, "Shape", None)
+    if shape is None:
+        return None
+    counts = {}
+    for element_type in ELEMENT_TYPES:
+        try:
+            counts[element_type] = shape.countElement(element_type)
+        except AttributeError:
+            #old FreeCAD
+            counts[element_type] = len(getattr(shape, _element_lists[element_type]))
+    return counts
+
+_topology_index = None
+
+def getTopologyIndex():
+    '''getTopologyIndex(): returns the shared TopologyIndex.'''
+    global _topology_index
+    if _topology_index is None:
+        _topology_index = TopologyIndex()
+    return _topology_index
+
+def StrFromLink(feature, subname):
+    return feature.Name+ ((":"+subname) if subname else "")
+    
+def LinkFromStr(strlink, document):
+    if len(strlink) == 0:
+        return None
+    pieces = strlink.split(":")
+    
+    feature = document.getObject(pieces[0])
+    
+    subname = ""
+    if feature is None:
+        raise ValueError("No object named {name}".format(name= pieces[0]))
+    if len(pieces) == 2:
+        subname = pieces[1]
+    elif len(pieces) > 2:
+        raise ValueError("Failed to parse link (more than one colon encountered)")
+    getTopologyIndex().checkSubname(feature, subname)
+    
+    return (feature,str(subname)) #wrap in str to remove unicode, which confuses assignment to PropertyLinkSubList.
+
+def StrListFromRefs(references):
+    '''input: PropertyLinkSubList. Output: list of strings for UI.'''
+    return [StrFromLink(feature,subelement) for (feature, subelement) in references]
+
+def RefsFromStrList(strings, document):
+    '''input: strings as from UI. Output: list of tuples that can be assigned to PropertyLinkSubList.'''
+    refs = []
+    for st in strings:
+        lnk = LinkFromStr(st, document)
+        if lnk is not None:
+            refs.append(lnk)
+    return refs
+
+class LinkParser(object):
+    '''LinkParser(document) - resolves many link strings at once. Object names are 
+    looked up in a name index of the document, built once when the parser is made, 
+    so it's for parsing large reference tables (a parser is only valid as long as no 
+    objects are added to or removed from the document). For a handful of strings, 
+    LinkFromStr is cheaper.'''
+    
+    def __init__(self, document):
+        self.document = document
+        self.objects = dict([(obj.Name, obj) for obj in document.Objects]) # dict. key = object Name, value = object
+    
+    def parse(self, strlink):
+        '''parse(strlink): same as LinkFromStr(strlink, self.document).'''
+        if len(strlink) == 0:
+            return None
+        (name, colon, subname) = strlink.partition(":")
+        feature = self.objects.get(name)
+        if feature is None:
+            raise ValueError("No object named {name}".format(name= name))
+        if ":" in subname:
+            raise ValueError("Failed to parse link (more than one colon encountered)")
+        getTopologyIndex().checkSubname(feature, subname)
+        return (feature, str(subname))
+    
+    def parseList(self, strings):
+        '''parseList(strings): same as RefsFromStrList(strings, self.document).'''
+        refs = []
+        for st in strings:
+            lnk = self.parse(st)
+            if lnk is not None:
+                refs.append(lnk)
+        return refs
@@ -0,0 +1,178 @@
+'''BenchmarkTempoVis - compares TempoVis.hide_all_dependent against the way it used
+to be done (full dependent list, then a filtered copy of it, then a type check
+and another pass in the old modifyVPProperty, with a has_key lookup and a
+restore_on_delete write per object), on a synthetic document. Both run with an
+empty DepGraphIndex, i.e. the new code traverses lazily rather than reusing a
+memoized closure.
+
+The synthetic document is made of lightweight stand-in objects, so that only
+the Python-side cost is measured, and no real document is needed. Run from
+FreeCAD's Python console (or FreeCADCmd):
+
+import BenchmarkTempoVis
+BenchmarkTempoVis.run() # 10000 objects by default'''
+
+import random
+import time
+from FrozenClass import FrozenClass
+
+import FreeCAD as App
+
+import DepGraphTools
+from DepGraphTools import _traverseDependent, _isContainerUncached
+from TempoVis import TempoVis
+
+class _ViewObject(object):
+    __slots__ = ["Visibility"]
+    def __init__(self):
+        self.Visibility = True
+
+class _Object(object):
+    '''stand-in for a document object: has what TempoVis and DepGraphTools use.'''
+    def __init__(self, document, name, bases):
+        self.Document = document
+        self.Name = name
+        self.TypeId = bases[0]
+        self.bases = bases # TypeId, followed by types it is derived from
+        self.InList = []
+        self.OutList = []
+        self.ViewObject = _ViewObject()
+
+    def isDerivedFrom(self, typeid):
+        return typeid in self.bases
+
+    def getTypeIdOfProperty(self, prop):
+        return "App::PropertyLinkList"
+
+class _Document(object):
+    def __init__(self, name):
+        self.Name = name
+        self.TypeId = "App::Document"
+        self.Objects = []
+        self.by_name = {} # dict. key = Name, value = object. Rebuilt when Objects grows.
+
+    def isDerivedFrom(self, typeid):
+        return typeid == "App::Document"
+
+    def getObject(self, name):
+        if len(self.by_name) != len(self.Objects):
+            self.by_name = dict([(obj.Name, obj) for obj in self.Objects])
+        return self.by_name.get(name)
+
+def _link(obj, dep):
+    obj.OutList.append(dep)
+    dep.InList.append(obj)
+
+def makeSyntheticDocument(n_objects = 10000, body_size = 50, bodies_per_part = 10, seed = 0):
+    '''makeSyntheticDocument(n_objects = 10000, body_size = 50, bodies_per_part = 10, seed = 0):
+    returns a stand-in document. Features form a random DAG in which every feature
+    depends on feature 0. Features are grouped into Bodies of body_size, Bodies into Parts.'''
+    rnd = random.Random(seed)
+    doc = _Document("SyntheticTempoVisBenchmark")
+    features = []
+    for i in range(n_objects):
+        feat = _Object(doc, "Feature{i}".format(i= i), ["Part::Feature", "App::GeoFeature", "App::DocumentObject"])
+        if i > 0:
+            _link(feat, features[rnd.randrange(i)])
+            if i > 1 and rnd.random() < 0.3:
+                dep = features[rnd.randrange(i)]
+                if not (dep in feat.OutList):
+                    _link(feat, dep)
+        features.append(feat)
+    doc.Objects.extend(features)
+    bodies = []
+    for i in range(0, n_objects, body_size):
+        body = _Object(doc, "Body{i}".format(i= len(bodies)), ["PartDesign::Body", "Part::BodyBase", "App::DocumentObject"])
+        for feat in features[i:i+body_size]:
+            _link(body, feat)
+        bodies.append(body)
+    doc.Objects.extend(bodies)
+    for i in range(0, len(bodies), bodies_per_part):
+        part = _Object(doc, "Part{i}".format(i= i // bodies_per_part), ["App::Part", "App::DocumentObjectGroup", "App::DocumentObject"])
+        for body in bodies[i:i+bodies_per_part]:
+            _link(part, body)
+        doc.Objects.append(part)
+    return doc
+
+class _LegacyTempoVis(FrozenClass):
+    '''the part of TempoVis that hide_all_dependent used, as it was before traversal,
+    filtering and writing were fused.'''
+
+    def __define_attributes(self):
+        self.data = {} # dict. key = ("Object","Property"), value = original value of the property
+        self.document = None
+        self.restore_on_delete = False
+
+        self._freeze()
+
+    def __init__(self, document):
+        self.__define_attributes()
+
+        self.document = document
+
+    def modifyVPProperty(self, doc_obj_or_list, prop_name, new_value):
+        if App.GuiUp:
+            if type(doc_obj_or_list) is not list:
+                doc_obj_or_list = [doc_obj_or_list]
+            for doc_obj in doc_obj_or_list:
+                if doc_obj.Document is not self.document:
+                    raise ValueError("Document object to be modified does not belong to document TempoVis was made for.")
+                oldval = getattr(doc_obj.ViewObject, prop_name)
+                setattr(doc_obj.ViewObject, prop_name, new_value)
+                has_key = getattr(self.data, "has_key", self.data.__contains__) #dict.has_key is gone in Python 3; same cost of a method call
+                if not has_key((doc_obj.Name,prop_name)):
+                    self.data[(doc_obj.Name,prop_name)] = oldval
+                    self.restore_on_delete = True
+
+    def hide_all_dependent(self, doc_obj):
+        self.modifyVPProperty( [o for o in _traverseDependent(doc_obj) if not _isContainerUncached(o)], "Visibility", False)
+
+    def restore(self):
+        for obj_name, prop_name in self.data:
+            setattr(self.document.getObject(obj_name).ViewObject, prop_name, self.data[(obj_name, prop_name)])
+        self.restore_on_delete = False
+
+def _timeOnce(doc, tempovis_class):
+    DepGraphTools._container_types.clear()
+    DepGraphTools.getDepGraphIndex(doc).invalidate()
+    tv = tempovis_class(doc)
+    t0 = time.time()
+    tv.hide_all_dependent(doc.Objects[0])
+    t1 = time.time()
+    tv.restore()
+    return t1 - t0
+
+def _median(values):
+    values = sorted(values)
+    n = len(values)
+    return values[n // 2] if n % 2 == 1 else (values[n // 2 - 1] + values[n // 2]) / 2.0
+
+def run(n_objects = 10000, repeat = 21):
+    '''run(n_objects = 10000, repeat = 21): times both implementations on a synthetic
+    document, alternating them, prints a report, and returns dict with median times 
+    in seconds. Single runs are noisy (20-40% here); use the median.'''
+    doc = makeSyntheticDocument(n_objects)
+    gui_up = App.GuiUp
+    App.GuiUp = 1 #TempoVis does nothing without GUI. Stand-ins don't need the real one.
+    try:
+        times = {"legacy": [], "fused": []}
+        for i in range(repeat):
+            times["legacy"].append(_timeOnce(doc, _LegacyTempoVis))
+            times["fused"].append(_timeOnce(doc, TempoVis))
+    finally:
+        App.GuiUp = gui_up
+        # the stand-in document is dropped here; unregister its index, so that it doesn't keep listening to real documents
+        DepGraphTools.getDepGraphIndex(doc).slotDeletedDocument(doc)
+    results = dict([(label, _median(times[label])) for label in times])
+    App.Console.PrintMessage(
+        "TempoVis.hide_all_dependent on {n} objects ({total} incl. containers), median of {r}:\n"
+        "  legacy: {legacy:.4f} s (min {legacy_min:.4f})\n"
+        "  fused:  {fused:.4f} s (min {fused_min:.4f})\n"
+        "  speedup: {ratio:.2f}x\n".format(n= n_objects, total= len(doc.Objects), r= repeat,
+                                            legacy= results["legacy"], fused= results["fused"],
+                                            legacy_min= min(times["legacy"]), fused_min= min(times["fused"]),
+                                            ratio= results["legacy"] / max(results["fused"], 1e-9)))
+    return results
+
+if __name__ == "__main__":
+    run()
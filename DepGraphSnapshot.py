@@ -0,0 +1,260 @@
+'''DepGraphSnapshot - compact, array-backed copy of dependency graph and container
+tree of a document, for analysis without touching live objects.
+
+Objects are numbered 0..N-1. Links are stored in CSR form: dependencies of
+object i are out_indices[out_offsets[i]:out_offsets[i+1]], dependents are
+in_indices[in_offsets[i]:in_offsets[i+1]]. Container tree is stored as an array
+of parent ids (ROOT for objects directly in the document).
+
+Snapshots can be saved to a file, and loaded back with arrays memory-mapped.
+Loading does not need FreeCAD, only NumPy.'''
+
+import json
+import struct
+
+import numpy
+
+ROOT = -1 # parent id of objects that are directly in the document
+NOT_A_TREE = -2 # parent id of objects that are in more than one container
+
+MAGIC = b"DGSNAP1\n"
+ARRAY_NAMES = ["out_offsets", "out_indices", "in_offsets", "in_indices", "parents", "types", "is_container"]
+
+class GraphSnapshot(object):
+    '''GraphSnapshot - see module docstring. Use makeSnapshot(document) or
+    loadSnapshot(filename) to obtain one.
+
+    Queries take and return object names, or ids where noted (methods ending with Ids).'''
+
+    def __init__(self, document_name, names, type_names, arrays):
+        self.document_name = document_name
+        self.names = names # list. Index = object id, value = object Name
+        self.ids = dict([(names[i], i) for i in range(len(names))]) # dict. key = object Name, value = object id
+        self.type_names = type_names # list of TypeIds; types[i] is index into this list
+        for key in ARRAY_NAMES:
+            setattr(self, key, arrays[key])
+
+    def __len__(self):
+        return len(self.names)
+
+    def getId(self, name):
+        '''getId(name): returns id of object named name. Raises KeyError if there is no such object.'''
+        return self.ids[name]
+
+    def getTypeId(self, name):
+        '''getTypeId(name): returns TypeId of object named name, as it was when snapshot was made.'''
+        return self.type_names[self.types[self.ids[name]]]
+
+    def _expand(self, offsets, indices, frontier):
+        '''returns concatenation of CSR rows of all ids in frontier.'''
+        starts = offsets[frontier]
+        counts = offsets[frontier + 1] - starts
+        total = int(counts.sum())
+        if total == 0:
+            return numpy.zeros(0, dtype= numpy.int64)
+        row_shift = numpy.repeat(starts - (numpy.cumsum(counts) - counts), counts)
+        return numpy.asarray(indices[row_shift + numpy.arange(total)], dtype= numpy.int64)
+
+    def _closureIds(self, offsets, indices, seed_ids, max_depth = None):
+        visited = numpy.zeros(len(self.names), dtype= bool)
+        frontier = numpy.unique(numpy.asarray(seed_ids, dtype= numpy.int64))
+        result = []
+        depth = 0
+        while len(frontier) > 0:
+            if max_depth is not None and depth >= max_depth:
+                break
+            depth += 1
+            nb = self._expand(offsets, indices, frontier)
+            nb = nb[~visited[nb]]
+            (nb, first) = numpy.unique(nb, return_index= True)
+            nb = nb[numpy.argsort(first)] #keep order of discovery
+            visited[nb] = True
+            result.append(nb)
+            frontier = nb
+        if len(result) == 0:
+            return numpy.zeros(0, dtype= numpy.int64)
+        return numpy.concatenate(result)
+
+    def getAllDependenciesIds(self, seed_ids, max_depth = None):
+        '''getAllDependenciesIds(seed_ids, max_depth = None): union of dependencies of all
+        seeds, as array of ids, nearest first.'''
+        return self._closureIds(self.out_offsets, self.out_indices, seed_ids, max_depth)
+
+    def getAllDependentIds(self, seed_ids, max_depth = None):
+        '''getAllDependentIds(seed_ids, max_depth = None): union of dependents of all
+        seeds, as array of ids, nearest first.'''
+        return self._closureIds(self.in_offsets, self.in_indices, seed_ids, max_depth)
+
+    def getAllDependencies(self, name, max_depth = None):
+        '''getAllDependencies(name, max_depth = None): same as DepGraphTools.getAllDependencies, on names.'''
+        return [self.names[i] for i in self.getAllDependenciesIds([self.ids[name]], max_depth)]
+
+    def getAllDependent(self, name, max_depth = None):
+        '''getAllDependent(name, max_depth = None): same as DepGraphTools.getAllDependent, on names.'''
+        return [self.names[i] for i in self.getAllDependentIds([self.ids[name]], max_depth)]
+
+    def dependsOn(self, name, dep_name, max_depth = None):
+        '''dependsOn(name, dep_name, max_depth = None): same as DepGraphTools.dependsOn, on
+        names. Searches from both ends, expanding the smaller frontier.'''
+        target_fwd = numpy.zeros(len(self.names), dtype= bool) # reached from name
+        target_bwd = numpy.zeros(len(self.names), dtype= bool) # reached from dep_name
+        frontier_fwd = numpy.array([self.ids[name]], dtype= numpy.int64)
+        frontier_bwd = numpy.array([self.ids[dep_name]], dtype= numpy.int64)
+        target_fwd[frontier_fwd] = True
+        target_bwd[frontier_bwd] = True
+        depth = 0
+        while len(frontier_fwd) > 0 and len(frontier_bwd) > 0:
+            if max_depth is not None and depth >= max_depth:
+                return False
+            depth += 1
+            if len(frontier_fwd) <= len(frontier_bwd):
+                nb = self._expand(self.out_offsets, self.out_indices, frontier_fwd)
+                if target_bwd[nb].any():
+                    return True
+                nb = numpy.unique(nb[~target_fwd[nb]])
+                target_fwd[nb] = True
+                frontier_fwd = nb
+            else:
+                nb = self._expand(self.in_offsets, self.in_indices, frontier_bwd)
+                if target_fwd[nb].any():
+                    return True
+                nb = numpy.unique(nb[~target_bwd[nb]])
+                target_bwd[nb] = True
+                frontier_bwd = nb
+        return False
+
+    def getContainerChainIds(self, obj_id):
+        '''getContainerChainIds(obj_id): list of ids of containers obj is in, outermost
+        first (document is not included, since it has no id).'''
+        chain = []
+        parent = int(self.parents[obj_id])
+        while parent != ROOT:
+            if parent == NOT_A_TREE or len(chain) > len(self.names):
+                raise ValueError("Container tree is not a tree")
+            chain.append(parent)
+            parent = int(self.parents[parent])
+        return chain[::-1]
+
+    def getContainerChain(self, name):
+        '''getContainerChain(name): same as DepGraphTools.getContainerChain, on names.
+        Document name comes first.'''
+        return [self.document_name] + [self.names[i] for i in self.getContainerChainIds(self.ids[name])]
+
+    def getCommonContainer(self, names):
+        '''getCommonContainer(names): same as DepGraphTools.getCommonContainer, on names.'''
+        if len(names) == 0:
+            raise ValueError("Empty list supplied, nothing to do")
+        common = self.getContainerChain(names[0])
+        for name in names[1:]:
+            chain = self.getContainerChain(name)
+            i = 0
+            while i < len(common) and i < len(chain) and common[i] == chain[i]:
+                i += 1
+            common = common[0:i]
+        return common[-1]
+
+    def isContainer(self, name):
+        '''isContainer(name): same as DepGraphTools.isContainer, as it was when snapshot was made.'''
+        return bool(self.is_container[self.ids[name]])
+
+    def save(self, filename):
+        '''save(filename): writes snapshot to a file. Arrays are stored raw and aligned,
+        so that loadSnapshot can memory-map them.'''
+        header = {"document": self.document_name,
+                  "names": self.names,
+                  "type_names": self.type_names,
+                  "arrays": {}}
+        arrays = [(key, numpy.ascontiguousarray(getattr(self, key))) for key in ARRAY_NAMES]
+        pos = 0 # offset relative to start of data, which follows the header
+        for (key, arr) in arrays:
+            header["arrays"][key] = [pos, arr.dtype.str, len(arr)]
+            pos += (arr.nbytes + 7) // 8 * 8
+        header_bytes = json.dumps(header).encode("utf-8")
+        data_start = (len(MAGIC) + 8 + len(header_bytes) + 7) // 8 * 8
+        with open(filename, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<Q", len(header_bytes)))
+            f.write(header_bytes)
+            f.write(b"\0" * (data_start - f.tell()))
+            for (key, arr) in arrays:
+                f.write(arr.tobytes())
+                f.write(b"\0" * ((arr.nbytes + 7) // 8 * 8 - arr.nbytes))
+
+def loadSnapshot(filename, mmap = True):
+    '''loadSnapshot(filename, mmap = True): reads snapshot saved by GraphSnapshot.save.
+    If mmap is True, arrays are memory-mapped (read-only) rather than read into memory.'''
+    with open(filename, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{file} is not a dependency graph snapshot".format(file= filename))
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len).decode("utf-8"))
+        data_start = (len(MAGIC) + 8 + header_len + 7) // 8 * 8
+        arrays = {}
+        for key in ARRAY_NAMES:
+            (pos, dtype, length) = header["arrays"][key]
+            if length == 0:
+                arrays[key] = numpy.zeros(0, dtype= dtype)
+            elif mmap:
+                arrays[key] = numpy.memmap(filename, dtype= dtype, mode= "r", offset= data_start + pos, shape= (length,))
+            else:
+                f.seek(data_start + pos)
+                arrays[key] = numpy.fromfile(f, dtype= dtype, count= length)
+    return GraphSnapshot(header["document"], header["names"], header["type_names"], arrays)
+
+def _toCSR(n, sources, targets):
+    order = numpy.argsort(sources, kind= "mergesort") # stable, to keep order of links
+    offsets = numpy.zeros(n + 1, dtype= numpy.int64)
+    numpy.cumsum(numpy.bincount(sources, minlength= n), out= offsets[1:])
+    return (offsets, numpy.asarray(targets, dtype= numpy.int32)[order])
+
+def makeSnapshot(document):
+    '''makeSnapshot(document): builds GraphSnapshot of a live document.'''
+    from DepGraphTools import getContainerIndex, isContainer
+
+    objects = document.Objects
+    names = [obj.Name for obj in objects]
+    ids = dict([(names[i], i) for i in range(len(names))])
+    # rows of both directions are taken from the live lists (rather than transposing 
+    # one into the other), so that traversals visit objects in the same order as 
+    # DepGraphTools ones
+    csr = {}
+    for (key, link_attr) in (("out", "OutList"), ("in", "InList")):
+        sources = []
+        targets = []
+        for i in range(len(objects)):
+            for dep in getattr(objects[i], link_attr):
+                j = ids.get(dep.Name)
+                if j is not None and dep.Document is document: #links to other documents are not recorded
+                    sources.append(i)
+                    targets.append(j)
+        csr[key] = _toCSR(len(objects), numpy.asarray(sources, dtype= numpy.int64), numpy.asarray(targets, dtype= numpy.int64))
+    (out_offsets, out_indices) = csr["out"]
+    (in_offsets, in_indices) = csr["in"]
+
+    index = getContainerIndex(document)
+    parents = numpy.full(len(objects), ROOT, dtype= numpy.int32)
+    for i in range(len(objects)):
+        try:
+            parent = index.getParent(objects[i])
+        except ValueError:
+            parents[i] = NOT_A_TREE
+            continue
+        if not parent.isDerivedFrom('App::Document'):
+            parents[i] = ids[parent.Name]
+
+    type_names = []
+    type_index = {}
+    types = numpy.zeros(len(objects), dtype= numpy.int32)
+    is_container = numpy.zeros(len(objects), dtype= numpy.uint8)
+    for i in range(len(objects)):
+        t = objects[i].TypeId
+        if not (t in type_index):
+            type_index[t] = len(type_names)
+            type_names.append(t)
+        types[i] = type_index[t]
+        is_container[i] = bool(isContainer(objects[i]))
+
+    arrays = {"out_offsets": out_offsets, "out_indices": out_indices,
+              "in_offsets": in_offsets, "in_indices": in_indices,
+              "parents": parents, "types": types, "is_container": is_container}
+    return GraphSnapshot(document.Name, names, type_names, arrays)
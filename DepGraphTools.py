@@ -1,9 +1,11 @@
 import FreeCAD as App
+from collections import OrderedDict
 
-def getAllDependencies(feat):
-    '''getAllDependencies(feat): gets all features feat depends on, directly or indirectly. 
-    Returns a list, with deepest dependencies last. feat is not included in the list, except 
-    if the feature depends on itself (dependency loop).'''
+from FrozenClass import FrozenClass
+import DocumentObserver
+
+def _traverseDependencies(feat):
+    '''_traverseDependencies(feat): uncached BFS over OutList. See getAllDependencies.'''
     list_traversing_now = [feat]
     set_of_deps = set()
     list_of_deps = []
@@ -21,18 +23,257 @@ def getAllDependencies(feat):
     
     return list_of_deps
 
+def _traverseDependent(feat):
+    '''_traverseDependent(feat): uncached BFS over InList. See getAllDependent.'''
+    list_traversing_now = [feat]
+    set_of_deps = set()
+    list_of_deps = []
+    
+    while len(list_traversing_now) > 0:
+        list_to_be_traversed_next = []
+        for feat in list_traversing_now:
+            for dep in feat.InList:
+                if not (dep in set_of_deps):
+                    set_of_deps.add(dep)
+                    list_of_deps.append(dep)
+                    list_to_be_traversed_next.append(dep)
+        
+        list_traversing_now = list_to_be_traversed_next
+    
+    return list_of_deps
+
+class DepGraphIndex(FrozenClass):
+    '''DepGraphIndex - memoized dependency closures of one document. Entries are 
+    dropped incrementally when the document reports a change to the dependency 
+    graph (object added or removed, link property changed), and the least 
+    recently used ones are evicted when the index grows past its budget.
+    
+    Don't construct directly, use getDepGraphIndex(document).'''
+    
+    def __define_attributes(self):
+        self.document = None
+        self.max_entries = 1024 #max number of closures to keep, per direction
+        self.max_size = 200000 #max total number of objects stored in closures, per direction
+        self.dependencies = OrderedDict() # key = object Name, value = (list of objects, set of names). Most recently used last.
+        self.dependent = OrderedDict() # same as dependencies, for the other direction
+        self.sizes = {"dependencies": 0, "dependent": 0} #total length of lists stored in each cache
+        self.stale = set() #names of objects whose links changed since closures were last checked. Processed on next lookup.
+        self.caching = False #False if document notifications are unavailable. Then nothing is ever cached.
+        self.hits = 0
+        self.misses = 0
+        
+        self._freeze()
+    
+    def __init__(self, document):
+        self.__define_attributes()
+        
+        self.document = document
+        self.caching = DocumentObserver.addListener(self)
+    
+    def _lookup(self, cache_name, feat, traverse):
+        self._dropStale()
+        cache = getattr(self, cache_name)
+        entry = cache.pop(feat.Name, None)
+        if entry is not None:
+            cache[feat.Name] = entry #move to end (most recently used)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        lst = traverse(feat)
+        entry = (lst, set([o.Name for o in lst]))
+        if not self.caching:
+            return entry
+        cache[feat.Name] = entry
+        self.sizes[cache_name] += len(lst)
+        while len(cache) > 1 and (len(cache) > self.max_entries or self.sizes[cache_name] > self.max_size):
+            (key, (old_lst, old_names)) = cache.popitem(last= False)
+            self.sizes[cache_name] -= len(old_lst)
+        return entry
+    
+    def _drop(self, cache_name, predicate):
+        cache = getattr(self, cache_name)
+        for key in [key for key in cache if predicate(key, cache[key][1])]:
+            self.sizes[cache_name] -= len(cache.pop(key)[0])
+    
+    def getAllDependencies(self, feat):
+        '''getAllDependencies(feat): same as DepGraphTools.getAllDependencies, but memoized.'''
+        return list(self._lookup("dependencies", feat, _traverseDependencies)[0])
+    
+    def getAllDependent(self, feat):
+        '''getAllDependent(feat): same as DepGraphTools.getAllDependent, but memoized.'''
+        return list(self._lookup("dependent", feat, _traverseDependent)[0])
+    
+    def getDependenciesNames(self, feat):
+        '''getDependenciesNames(feat): returns set of names of getAllDependencies(feat). 
+        Returned set is shared with the cache, don't modify it.'''
+        return self._lookup("dependencies", feat, _traverseDependencies)[1]
+    
+    def getDependentNames(self, feat):
+        '''getDependentNames(feat): returns set of names of getAllDependent(feat). 
+        Returned set is shared with the cache, don't modify it.'''
+        return self._lookup("dependent", feat, _traverseDependent)[1]
+    
+    def _peek(self, cache_name, feat):
+        self._dropStale()
+        return getattr(self, cache_name).get(feat.Name)
+    
+    def getCachedDependencies(self, feat):
+        '''getCachedDependencies(feat): returns getAllDependencies(feat) if it is in the 
+        cache, or None if it isn't (never traverses). Returned list is shared with the 
+        cache, don't modify it.'''
+        entry = self._peek("dependencies", feat)
+        return None if entry is None else entry[0]
+    
+    def getCachedDependent(self, feat):
+        '''getCachedDependent(feat): returns getAllDependent(feat) if it is in the cache, 
+        or None if it isn't (never traverses). Returned list is shared with the cache, 
+        don't modify it.'''
+        entry = self._peek("dependent", feat)
+        return None if entry is None else entry[0]
+    
+    def getCachedDependenciesNames(self, feat):
+        '''getCachedDependenciesNames(feat): same as getDependenciesNames(feat) if it is 
+        in the cache, None if it isn't (never traverses).'''
+        entry = self._peek("dependencies", feat)
+        return None if entry is None else entry[1]
+    
+    def getCachedDependentNames(self, feat):
+        '''getCachedDependentNames(feat): same as getDependentNames(feat) if it is in 
+        the cache, None if it isn't (never traverses).'''
+        entry = self._peek("dependent", feat)
+        return None if entry is None else entry[1]
+    
+    def invalidate(self):
+        '''invalidate(): forget everything.'''
+        self.dependencies.clear()
+        self.dependent.clear()
+        self.sizes = {"dependencies": 0, "dependent": 0}
+        self.stale = set()
+    
+    def onLinksChanged(self, obj):
+        '''onLinksChanged(obj): marks closures affected by a change of links of obj as 
+        stale. They are dropped on next lookup, so that a burst of changes (e.g. during 
+        recompute) costs one pass rather than one per change.'''
+        self.stale.add(obj.Name)
+    
+    def _dropStale(self):
+        if len(self.stale) == 0:
+            return
+        changed = self.stale
+        self.stale = set()
+        # dependencies of K change if K is a changed object, or K depends on one
+        self._drop("dependencies", lambda key, names: key in changed or not changed.isdisjoint(names))
+        # dependent of K change if a changed object was among them (old links), or if K is reachable from one now (new links)
+        self._drop("dependent", lambda key, names: key in changed or not changed.isdisjoint(names))
+        if len(self.dependent) > 0:
+            objects = [self.document.getObject(name) for name in changed]
+            new_deps = set([o.Name for o in _batchTraverse([o for o in objects if o is not None], "OutList")])
+            self._drop("dependent", lambda key, names: key in new_deps)
+    
+    def onObjectRemoved(self, obj):
+        '''onObjectRemoved(obj): drops closures that mention obj.'''
+        name = obj.Name
+        self._drop("dependencies", lambda key, names: key == name or name in names)
+        self._drop("dependent", lambda key, names: key == name or name in names)
+    
+    #document notifications
+    def slotCreatedObject(self, obj):
+        if obj.Document is self.document:
+            #a new object has no links yet, but it may reuse the name of a deleted one
+            name = obj.Name
+            self._drop("dependencies", lambda key, names: key == name)
+            self._drop("dependent", lambda key, names: key == name)
+    
+    def slotDeletedObject(self, obj):
+        if obj.Document is self.document:
+            self.onObjectRemoved(obj)
+    
+    def slotChangedObject(self, obj, prop):
+        if obj.Document is self.document and DocumentObserver.isLinkProperty(obj, prop):
+            self.onLinksChanged(obj)
+    
+    def slotDeletedDocument(self, doc):
+        if doc is self.document:
+            self.invalidate()
+            DocumentObserver.removeListener(self)
+            _indexes.pop(doc.Name, None)
+
+_indexes = {} # dict. key = document name, value = DepGraphIndex
+
+def getDepGraphIndex(document):
+    '''getDepGraphIndex(document): returns DepGraphIndex of the document, creating it if necessary.'''
+    index = _indexes.get(document.Name)
+    if index is None or index.document is not document:
+        index = DepGraphIndex(document)
+        _indexes[document.Name] = index
+    return index
+
+def getAllDependencies(feat):
+    '''getAllDependencies(feat): gets all features feat depends on, directly or indirectly. 
+    Returns a list, with deepest dependencies last (breadth-first order, which is not a 
+    topological order; see getTopologicalOrder). feat is not included in the list, except 
+    if the feature depends on itself (dependency loop).'''
+    return getDepGraphIndex(feat.Document).getAllDependencies(feat)
+
 def getAllDependent(feat):
     '''getAllDependent(feat): gets all features that depend on feat, directly or indirectly. 
-    Returns a list, with deepest dependencies last. feat is not included in the list, except 
+    Returns a list, with deepest dependencies last (breadth-first order, which is not a 
+    topological order; see getTopologicalOrder). feat is not included in the list, except 
     if the feature depends on itself (dependency loop).'''
+    return getDepGraphIndex(feat.Document).getAllDependent(feat)
+
+def _iterTraverse(feat, link_attr, max_depth, descend, stop):
+    set_of_deps = set()
     list_traversing_now = [feat]
+    depth = 0
+    while len(list_traversing_now) > 0:
+        if max_depth is not None and depth >= max_depth:
+            return
+        depth += 1
+        list_to_be_traversed_next = []
+        for feat in list_traversing_now:
+            for dep in getattr(feat, link_attr):
+                if not (dep in set_of_deps):
+                    set_of_deps.add(dep)
+                    yield dep
+                    if stop is not None and stop(dep):
+                        return
+                    if descend is None or descend(dep):
+                        list_to_be_traversed_next.append(dep)
+        
+        list_traversing_now = list_to_be_traversed_next
+
+def iterDependencies(feat, max_depth = None, descend = None, stop = None):
+    '''iterDependencies(feat, max_depth = None, descend = None, stop = None): generator 
+    version of getAllDependencies. Yields features in the same order, computing them 
+    only as they are requested. 
+    
+    max_depth: if not None, features further than max_depth links from feat are not visited. 
+    descend: if not None, descend(obj) is called for every yielded obj; if it returns 
+    False, dependencies of obj are not traversed (unless reached via another path). 
+    stop: if not None, stop(obj) is called for every yielded obj; if it returns True, 
+    iteration ends right after obj.
+    
+    Example: first sketch feat depends on:
+    next(iterDependencies(feat, stop= lambda o: o.isDerivedFrom("Sketcher::SketchObject")))'''
+    return _iterTraverse(feat, "OutList", max_depth, descend, stop)
+
+def iterDependent(feat, max_depth = None, descend = None, stop = None):
+    '''iterDependent(feat, max_depth = None, descend = None, stop = None): generator 
+    version of getAllDependent. See iterDependencies for description of arguments.'''
+    return _iterTraverse(feat, "InList", max_depth, descend, stop)
+
+def _batchTraverse(feat_list, link_attr):
+    '''_batchTraverse(feat_list, link_attr): multi-source BFS. Returns union of 
+    closures of all features in feat_list, along link_attr ("InList" or "OutList").'''
+    list_traversing_now = list(feat_list)
     set_of_deps = set()
     list_of_deps = []
     
     while len(list_traversing_now) > 0:
         list_to_be_traversed_next = []
         for feat in list_traversing_now:
-            for dep in feat.InList:
+            for dep in getattr(feat, link_attr):
                 if not (dep in set_of_deps):
                     set_of_deps.add(dep)
                     list_of_deps.append(dep)
@@ -42,13 +283,293 @@ def getAllDependent(feat):
     
     return list_of_deps
 
-def isContainer(obj):
-    '''isContainer(obj): returns True if obj is an object container, such as 
-    Group, Part, Body. The important characterisic of an object being a 
-    container is its action on visibility of linked objects. E.g. a 
-    Part::Compound is not a group, because it does not affect visibility 
-    of originals. Documents are considered containers, too.'''
+def getAllDependenciesBatch(feat_list):
+    '''getAllDependenciesBatch(feat_list): same as union of getAllDependencies of 
+    every feature in feat_list, but done in one traversal. A seed is included if it 
+    is a dependency of another seed (or of itself).'''
+    return _batchTraverse(feat_list, "OutList")
+
+def getAllDependentBatch(feat_list):
+    '''getAllDependentBatch(feat_list): same as union of getAllDependent of every 
+    feature in feat_list, but done in one traversal. A seed is included if it 
+    depends on another seed (or on itself).'''
+    return _batchTraverse(feat_list, "InList")
+
+class ClosureMembership(FrozenClass):
+    '''ClosureMembership - result of a batched traversal with per-seed membership. 
+    Objects are numbered in order of discovery; for every object, a bitmask 
+    (python integer) tells which seeds' closures it belongs to: bit i is set if 
+    the object is in closure of seeds[i].
+    
+    Constructed by getDependenciesMembership and getDependentMembership.'''
+    
+    def __define_attributes(self):
+        self.seeds = [] #list of seed features, as supplied
+        self.objects = [] #list of all objects in union of closures. Index in this list is the object id.
+        self.masks = [] #list of integers, one per object. Bit i set = object is in closure of seeds[i].
+        self.ids = {} #dict. key = object Name, value = object id
+        
+        self._freeze()
+    
+    def __init__(self, seeds):
+        self.__define_attributes()
+        
+        self.seeds = list(seeds)
+    
+    def getMask(self, obj):
+        '''getMask(obj): returns bitmask of seeds whose closure contains obj. 0 if none.'''
+        i = self.ids.get(obj.Name)
+        if i is None:
+            return 0
+        return self.masks[i]
+    
+    def contains(self, seed_index, obj):
+        '''contains(seed_index, obj): returns True if obj is in closure of seeds[seed_index].'''
+        return bool(self.getMask(obj) >> seed_index & 1)
+    
+    def getClosure(self, seed_index):
+        '''getClosure(seed_index): returns list of objects in closure of seeds[seed_index], in order of discovery.'''
+        bit = 1 << seed_index
+        return [self.objects[i] for i in range(len(self.objects)) if self.masks[i] & bit]
+    
+    def getSeeds(self, obj):
+        '''getSeeds(obj): returns list of seeds whose closure contains obj.'''
+        mask = self.getMask(obj)
+        return [self.seeds[i] for i in range(len(self.seeds)) if mask >> i & 1]
+
+def _batchTraverseMembership(feat_list, link_attr):
+    result = ClosureMembership(feat_list)
+    ids = result.ids
+    masks = result.masks
+    #propagating mask of an object = its membership mask + bits of seeds it is
+    seed_bits = {}
+    for i in range(len(feat_list)):
+        name = feat_list[i].Name
+        seed_bits[name] = seed_bits.get(name, 0) | (1 << i)
+    
+    list_traversing_now = list(feat_list)
+    propagating = dict([(feat.Name, seed_bits[feat.Name]) for feat in feat_list])
+    while len(list_traversing_now) > 0:
+        list_to_be_traversed_next = []
+        set_to_be_traversed_next = set()
+        for feat in list_traversing_now:
+            prop_mask = propagating[feat.Name]
+            for dep in getattr(feat, link_attr):
+                i = ids.get(dep.Name)
+                if i is None:
+                    i = len(result.objects)
+                    ids[dep.Name] = i
+                    result.objects.append(dep)
+                    masks.append(0)
+                new_mask = masks[i] | prop_mask
+                if new_mask != masks[i]:
+                    masks[i] = new_mask
+                    propagating[dep.Name] = new_mask | seed_bits.get(dep.Name, 0)
+                    if not (dep.Name in set_to_be_traversed_next):
+                        set_to_be_traversed_next.add(dep.Name)
+                        list_to_be_traversed_next.append(dep)
+        
+        list_traversing_now = list_to_be_traversed_next
+    
+    return result
+
+def getDependenciesMembership(feat_list):
+    '''getDependenciesMembership(feat_list): batched getAllDependencies, that also 
+    tells which seed each dependency came from. Returns ClosureMembership.'''
+    return _batchTraverseMembership(feat_list, "OutList")
+
+def getDependentMembership(feat_list):
+    '''getDependentMembership(feat_list): batched getAllDependent, that also 
+    tells which seed each dependent came from. Returns ClosureMembership.'''
+    return _batchTraverseMembership(feat_list, "InList")
+
+class DependencyLoopError(ValueError):
+    '''DependencyLoopError - raised when an operation needs an acyclic dependency graph, 
+    but there are loops. Attribute cycles is the list of offending strongly connected 
+    components (lists of objects).'''
+    def __init__(self, cycles):
+        ValueError.__init__(self, "Dependency loop detected: {loops}".format(
+            loops= "; ".join([", ".join([o.Name for o in cycle]) for cycle in cycles])))
+        self.cycles = cycles
+
+def _objectList(doc_or_objects):
+    if hasattr(doc_or_objects, "isDerivedFrom") and doc_or_objects.isDerivedFrom('App::Document'):
+        return doc_or_objects.Objects
+    return list(doc_or_objects)
+
+def getStronglyConnectedComponents(doc_or_objects):
+    '''getStronglyConnectedComponents(doc_or_objects): splits objects (all objects of a 
+    document, or a list of objects) into strongly connected components of the dependency 
+    graph (Tarjan's algorithm, O(V+E)). Links to objects outside of the supplied set 
+    are ignored. Returns list of lists of objects. Components come in topological 
+    order, dependencies first: a component only depends on components before it.'''
+    
+    objects = _objectList(doc_or_objects)
+    members = set([o.Name for o in objects])
+    index_of = {} # key = object Name, value = discovery index
+    lowlink = {} # key = object Name, value = lowest discovery index reachable
+    stack = []
+    on_stack = set()
+    components = []
+    counter = 0
+    
+    for root in objects:
+        if root.Name in index_of:
+            continue
+        index_of[root.Name] = lowlink[root.Name] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root.Name)
+        work = [(root, iter(root.OutList))]
+        while len(work) > 0:
+            (node, links) = work[-1]
+            descended = False
+            for dep in links:
+                if not (dep.Name in members):
+                    continue
+                if not (dep.Name in index_of):
+                    index_of[dep.Name] = lowlink[dep.Name] = counter
+                    counter += 1
+                    stack.append(dep)
+                    on_stack.add(dep.Name)
+                    work.append((dep, iter(dep.OutList)))
+                    descended = True
+                    break
+                elif dep.Name in on_stack:
+                    lowlink[node.Name] = min(lowlink[node.Name], index_of[dep.Name])
+            if descended:
+                continue
+            work.pop()
+            if len(work) > 0:
+                parent = work[-1][0]
+                lowlink[parent.Name] = min(lowlink[parent.Name], lowlink[node.Name])
+            if lowlink[node.Name] == index_of[node.Name]:
+                component = []
+                while True:
+                    o = stack.pop()
+                    on_stack.discard(o.Name)
+                    component.append(o)
+                    if o is node:
+                        break
+                components.append(component[::-1])
+    return components
+
+def _isCycle(component):
+    if len(component) > 1:
+        return True
+    return component[0] in component[0].OutList
+
+def getDependencyLoops(doc_or_objects):
+    '''getDependencyLoops(doc_or_objects): returns list of dependency loops, each loop 
+    being a strongly connected component of more than one object (or an object that 
+    links to itself). Empty list if the graph is acyclic.'''
+    return [c for c in getStronglyConnectedComponents(doc_or_objects) if _isCycle(c)]
+
+def getTopologicalOrder(doc_or_objects):
+    '''getTopologicalOrder(doc_or_objects): returns list of objects sorted so that every 
+    object comes after all objects it depends on, i.e. in valid recompute order. 
+    O(V+E). Raises DependencyLoopError if there are dependency loops.'''
+    components = getStronglyConnectedComponents(doc_or_objects)
+    cycles = [c for c in components if _isCycle(c)]
+    if len(cycles) > 0:
+        raise DependencyLoopError(cycles)
+    return [c[0] for c in components]
+
+def getDependencyLevels(doc_or_objects):
+    '''getDependencyLevels(doc_or_objects): returns list of levels (lists of objects). 
+    Objects of level 0 depend on nothing (within the supplied set), objects of level k 
+    depend only on objects of lower levels, at least one of them of level k-1. Objects 
+    of one level don't depend on each other, so they can be recomputed concurrently, 
+    once lower levels are done. Raises DependencyLoopError if there are dependency loops.'''
+    order = getTopologicalOrder(doc_or_objects)
+    level_of = {} # key = object Name, value = level
+    levels = []
+    for obj in order:
+        lvl = 0
+        for dep in obj.OutList:
+            dep_lvl = level_of.get(dep.Name)
+            if dep_lvl is not None and dep_lvl + 1 > lvl:
+                lvl = dep_lvl + 1
+        level_of[obj.Name] = lvl
+        if lvl == len(levels):
+            levels.append([])
+        levels[lvl].append(obj)
+    return levels
+
+def _pathTo(parents, node):
+    path = []
+    while node is not None:
+        path.append(node)
+        node = parents[node]
+    return path
+
+def dependsOn(feat, dep, max_depth = None, return_path = False):
+    '''dependsOn(feat, dep, max_depth = None, return_path = False): tests if feat 
+    depends on dep, directly or indirectly. Stops as soon as a link chain is found. 
+    Searches from both ends (OutList of feat, InList of dep), always expanding the 
+    smaller frontier. 
+    
+    max_depth: if not None, only link chains of up to max_depth links are considered.
+    
+    Returns True/False. If return_path is True, returns the chain of features 
+    [feat, ..., dep] instead of True, and None instead of False. 
+    
+    dependsOn(feat, feat) is True only if there is a dependency loop.'''
+    
+    if max_depth is None and not return_path and dep.Document is feat.Document:
+        # a closure known to the cache answers right away (cache is keyed by name, so only within one document)
+        index = getDepGraphIndex(feat.Document)
+        names = index.getCachedDependentNames(dep)
+        if names is not None:
+            return feat.Name in names
+        names = index.getCachedDependenciesNames(feat)
+        if names is not None:
+            return dep.Name in names
     
+    parents_fwd = {feat: None} # key = feature reached from feat, value = previous feature on the chain (towards feat)
+    parents_bwd = {dep: None} # key = feature reached from dep, value = next feature on the chain (towards dep)
+    frontier_fwd = [feat]
+    frontier_bwd = [dep]
+    depth = 0 #length of the longest chain examined so far
+    meeting = None #(node_towards_feat, node_towards_dep) of the link where searches met
+    
+    while len(frontier_fwd) > 0 and len(frontier_bwd) > 0 and meeting is None:
+        if max_depth is not None and depth >= max_depth:
+            break
+        depth += 1
+        next_frontier = []
+        if len(frontier_fwd) <= len(frontier_bwd):
+            for f in frontier_fwd:
+                for d in f.OutList:
+                    if d in parents_bwd:
+                        meeting = (f, d)
+                        break
+                    if not (d in parents_fwd):
+                        parents_fwd[d] = f
+                        next_frontier.append(d)
+                if meeting is not None:
+                    break
+            frontier_fwd = next_frontier
+        else:
+            for d in frontier_bwd:
+                for f in d.InList:
+                    if f in parents_fwd:
+                        meeting = (f, d)
+                        break
+                    if not (f in parents_bwd):
+                        parents_bwd[f] = d
+                        next_frontier.append(f)
+                if meeting is not None:
+                    break
+            frontier_bwd = next_frontier
+    
+    if meeting is None:
+        return None if return_path else False
+    if not return_path:
+        return True
+    return _pathTo(parents_fwd, meeting[0])[::-1] + _pathTo(parents_bwd, meeting[1])
+
+def _isContainerUncached(obj):
     if obj.isDerivedFrom("App::DocumentObjectGroup"):
         return True
     if obj.isDerivedFrom("PartDesign::Body"):
@@ -57,8 +578,30 @@ def isContainer(obj):
         return True
     if obj.isDerivedFrom('App::Document'):
         return True
+    return False
 
-def getContainer(feat):
+_container_types = {} # dict. key = TypeId, value = True if objects of this type are containers
+
+def isContainer(obj):
+    '''isContainer(obj): returns True if obj is an object container, such as 
+    Group, Part, Body. The important characterisic of an object being a 
+    container is its action on visibility of linked objects. E.g. a 
+    Part::Compound is not a group, because it does not affect visibility 
+    of originals. Documents are considered containers, too.
+    
+    Result is cached per TypeId.'''
+    
+    typeid = getattr(obj, "TypeId", None)
+    if typeid is None:
+        return _isContainerUncached(obj)
+    result = _container_types.get(typeid)
+    if result is None:
+        result = _isContainerUncached(obj)
+        _container_types[typeid] = result
+    return result
+
+def _findContainer(feat):
+    '''_findContainer(feat): uncached lookup of the container directly containing feat.'''
     cnt = None
     for dep in feat.InList:
         if isContainer(dep):
@@ -69,32 +612,244 @@ def getContainer(feat):
         return feat.Document
     return cnt
 
+class ContainerIndex(FrozenClass):
+    '''ContainerIndex - container tree of one document, cached. For every object 
+    looked up, the chain of containers (parent pointers all the way up to the 
+    document) is stored as a tuple, and shared with the chains of its children. 
+    Depth of an object is the length of its chain. Entries are dropped when a 
+    container changes its links, or when a container is deleted.
+    
+    Cumulative placements of containers (relative to the document) are cached 
+    too, and are dropped when Placement of the container or any of its 
+    ancestors changes.
+    
+    Don't construct directly, use getContainerIndex(document).'''
+    
+    def __define_attributes(self):
+        self.document = None
+        self.chains = {} # dict. key = object Name, value = tuple of containers, document first, direct container last
+        self.placements = {} # dict. key = container Name, value = global placement of the container. Only for containers that are in self.chains.
+        self.caching = False #False if document notifications are unavailable. Then nothing is ever cached.
+        
+        self._freeze()
+    
+    def __init__(self, document):
+        self.__define_attributes()
+        
+        self.document = document
+        self.caching = DocumentObserver.addListener(self)
+    
+    def getChain(self, feat):
+        '''getChain(feat): returns tuple of containers feat is in, document first. 
+        Empty tuple for the document itself.'''
+        if feat.isDerivedFrom('App::Document'):
+            return ()
+        chain = self.chains.get(feat.Name)
+        if chain is not None:
+            return chain
+        
+        #walk up until the document or an object with known chain is met
+        path = [feat] #path[i+1] is container of path[i]
+        visited = set([feat.Name])
+        while True:
+            cnt = _findContainer(path[-1])
+            if cnt.isDerivedFrom('App::Document'):
+                chain = (cnt,)
+                break
+            known = self.chains.get(cnt.Name)
+            if known is not None:
+                chain = known + (cnt,)
+                break
+            if cnt.Name in visited:
+                raise ValueError("Container tree is not a tree (containers contain each other)")
+            visited.add(cnt.Name)
+            path.append(cnt)
+        
+        #now chain is the chain of path[-1]. Fill in the rest, top-down.
+        for i in range(len(path)-1, -1, -1):
+            if self.caching:
+                self.chains[path[i].Name] = chain
+            if i > 0:
+                chain = chain + (path[i],)
+        return chain
+    
+    def getParent(self, feat):
+        '''getParent(feat): returns the container directly containing feat (document, 
+        if feat is not in any container). None for the document itself.'''
+        chain = self.getChain(feat)
+        if len(chain) == 0:
+            return None
+        return chain[-1]
+    
+    def getDepth(self, feat):
+        '''getDepth(feat): returns number of containers feat is in, document included. 0 for the document.'''
+        return len(self.getChain(feat))
+    
+    def getChildren(self, cnt):
+        '''getChildren(cnt): returns list of objects directly contained by container cnt 
+        (which can be the document).'''
+        if cnt.isDerivedFrom('App::Document'):
+            candidates = cnt.Objects
+        else:
+            candidates = cnt.OutList
+        children = []
+        seen = set()
+        for obj in candidates:
+            if obj.Name in seen or obj.Document is not self.document:
+                continue
+            seen.add(obj.Name)
+            if self.getParent(obj) is cnt:
+                children.append(obj)
+        return children
+    
+    def getGlobalPlacement(self, cnt):
+        '''getGlobalPlacement(cnt): returns placement of local coordinate system of 
+        container cnt relative to the document. The returned Placement is shared 
+        with the cache, don't modify it.'''
+        if cnt.isDerivedFrom('App::Document'):
+            return App.Placement()
+        plm = self.placements.get(cnt.Name)
+        if plm is not None:
+            return plm
+        chain = self.getChain(cnt)
+        parent_plm = App.Placement()
+        if len(chain) > 1:
+            parent_plm = self.getGlobalPlacement(chain[-1])
+        if hasattr(cnt, "Placement"):
+            plm = parent_plm.multiply(cnt.Placement)
+        else:
+            plm = parent_plm
+        if self.caching:
+            self.placements[cnt.Name] = plm
+        return plm
+    
+    def invalidate(self):
+        '''invalidate(): forget everything.'''
+        self.chains = {}
+        self.placements = {}
+    
+    def _dropSubtree(self, names, placements_only = False):
+        for key in [key for key in self.chains if key in names
+                    or any(cnt.Name in names for cnt in self.chains[key][1:])]:
+            self.placements.pop(key, None)
+            if not placements_only:
+                del self.chains[key]
+    
+    #document notifications
+    def slotCreatedObject(self, obj):
+        if obj.Document is self.document:
+            self.chains.pop(obj.Name, None)
+            self.placements.pop(obj.Name, None)
+    
+    def slotDeletedObject(self, obj):
+        if obj.Document is self.document:
+            if isContainer(obj):
+                self._dropSubtree(set([obj.Name]))
+            else:
+                self.chains.pop(obj.Name, None)
+                self.placements.pop(obj.Name, None)
+    
+    def slotChangedObject(self, obj, prop):
+        if obj.Document is self.document and isContainer(obj) and DocumentObserver.isLinkProperty(obj, prop):
+            # objects that were in obj are in its subtree; objects that are in obj now are in its OutList
+            self._dropSubtree(set([obj.Name] + [o.Name for o in obj.OutList]))
+        elif obj.Document is self.document and prop == "Placement" and obj.Name in self.placements:
+            self._dropSubtree(set([obj.Name]), placements_only= True)
+    
+    def slotDeletedDocument(self, doc):
+        if doc is self.document:
+            self.invalidate()
+            DocumentObserver.removeListener(self)
+            _container_indexes.pop(doc.Name, None)
+
+_container_indexes = {} # dict. key = document name, value = ContainerIndex
+
+def getContainerIndex(document):
+    '''getContainerIndex(document): returns ContainerIndex of the document, creating it if necessary.'''
+    index = _container_indexes.get(document.Name)
+    if index is None or index.document is not document:
+        index = ContainerIndex(document)
+        _container_indexes[document.Name] = index
+    return index
+
+def _getChain(feat):
+    if feat.isDerivedFrom('App::Document'):
+        return ()
+    return getContainerIndex(feat.Document).getChain(feat)
+
+def _commonLength(chain_a, chain_b):
+    '''_commonLength(chain_a, chain_b): returns length of common leading part of two 
+    container chains. Chains share all containers up to the lowest common one, and 
+    differ past it, so binary search is possible.'''
+    lo = 0
+    hi = min(len(chain_a), len(chain_b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if chain_a[mid-1] is chain_b[mid-1]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def getContainer(feat):
+    '''getContainer(feat): returns the container directly containing feat (document, 
+    if feat is not in any container).'''
+    return _getChain(feat)[-1]
+
 def getContainerChain(feat):
     '''getContainerChain(feat): return a list of containers feat is in. 
     Last container directly contains the feature. 
     Example of output:  [<document>,<SuperPart>,<Part>,<Body>]'''
     
-    if feat.isDerivedFrom('App::Document'):
-        return []
-    
-    list_traversing_now = [feat]
-    set_of_deps = set()
-    list_of_deps = []
+    return list(_getChain(feat))
+
+def getContainerContents(container):
+    '''getContainerContents(container): returns list of objects directly contained by 
+    container (not including contents of nested containers). container can be a document.'''
+    if not isContainer(container):
+        raise TypeError("container is not a container!")
+    if container.isDerivedFrom('App::Document'):
+        return getContainerIndex(container).getChildren(container)
+    return getContainerIndex(container.Document).getChildren(container)
+
+def iterContainerChain(feat, max_depth = None, stop = None):
+    '''iterContainerChain(feat, max_depth = None, stop = None): generator version of 
+    getContainerChain, in reverse order: yields the container directly containing feat 
+    first, and the document last. Walks up only as far as requested, unless the 
+    chain is already known to the container index.
     
-    while len(list_traversing_now) > 0:
-        list_to_be_traversed_next = []
-        for feat in list_traversing_now:
-            for dep in feat.InList:
-                if isContainer(dep):
-                    if not (dep in set_of_deps):
-                        set_of_deps.add(dep)
-                        list_of_deps.append(dep)
-                        list_to_be_traversed_next.append(dep)
-        if len(list_to_be_traversed_next) > 1:
-            raise ValueError("Container tree is not a tree")
-        list_traversing_now = list_to_be_traversed_next
+    max_depth: if not None, at most max_depth containers are yielded. 
+    stop: if not None, stop(cnt) is called for every yielded cnt; if it returns True, 
+    iteration ends right after cnt.
     
-    return [feat.Document] + list_of_deps[::-1]
+    Example: first Body above feat, or None:
+    next(iterContainerChain(feat, stop= lambda c: c.isDerivedFrom("PartDesign::Body")), None)'''
+    if feat.isDerivedFrom('App::Document'):
+        return
+    index = getContainerIndex(feat.Document)
+    known = index.chains.get(feat.Name)
+    count = 0
+    visited = set([feat.Name])
+    while True:
+        if max_depth is not None and count >= max_depth:
+            return
+        if known is not None:
+            cnt = known[-1]
+            known = known[:-1] if len(known) > 1 else None
+        else:
+            cnt = _findContainer(feat)
+            if not cnt.isDerivedFrom('App::Document'):
+                if cnt.Name in visited:
+                    raise ValueError("Container tree is not a tree (containers contain each other)")
+                visited.add(cnt.Name)
+                known = index.chains.get(cnt.Name)
+        count += 1
+        yield cnt
+        if cnt.isDerivedFrom('App::Document'):
+            return
+        if stop is not None and stop(cnt):
+            return
+        feat = cnt
 
 def getContainerRelativePath(container_from, container_to):
     '''getContainerRelativePath(container_from, container_to): finds container 
@@ -107,19 +862,12 @@ def getContainerRelativePath(container_from, container_to):
     if not isContainer(container_to):
         raise TypeError("container_to is not a container!")
     
-    chain_from = getContainerChain(container_from) + [container_from]
-    chain_to = getContainerChain(container_to) + [container_to]
+    chain_from = _getChain(container_from) + (container_from,)
+    chain_to = _getChain(container_to) + (container_to,)
     
-    #find common leading sequence, and chop it off
-    i = 0
-    for i in range(min(len(chain_from), len(chain_to))):
-        if chain_from[i] is not chain_to[i]:
-            break;
-    # now i points to first level where container chains differ
-    chain_from = chain_from[i:]
-    chain_to = chain_to[i:]
-    
-    return (chain_from, chain_to)
+    # chop off common leading sequence (down to lowest common container, inclusive)
+    i = _commonLength(chain_from, chain_to)
+    return (list(chain_from[i:]), list(chain_to[i:]))
     
 def getCommonContainer(feat_list):
     '''getCommonContainer(feat_list): Returns the deepest common container that 
@@ -128,20 +876,44 @@ def getCommonContainer(feat_list):
     
     if len(feat_list) == 0:
         raise ValueError("Empty list supplied, nothing to do")
-    list_of_chains = [getContainerChain(feat) for feat in feat_list]
-    min_path_length = min([len(chain) for chain in list_of_chains])
-
-    i = 0
-    for i in range(min_path_length):
-        cnt0 = list_of_chains[0][i]
-        for l in list_of_chains:
-            if l[i] is not cnt0:
-                break
-    # now i points to first level where container chains differ
-    i -= 1
-    if i < 0:
-        return None #can happen if features are not from one document
-    return list_of_chains[0][i]
+    common = _getChain(feat_list[0])
+    for feat in feat_list[1:]:
+        common = common[0:_commonLength(common, _getChain(feat))]
+        if len(common) == 0:
+            return None #can happen if features are not from one document
+    if len(common) == 0:
+        return None
+    return common[-1]
+
+def getGlobalPlacement(container):
+    '''getGlobalPlacement(container): returns placement of local coordinate system of 
+    container relative to the document (a product of Placements of all containers 
+    from the document down to container). Cached.'''
+    if not isContainer(container):
+        raise TypeError("container is not a container!")
+    if container.isDerivedFrom('App::Document'):
+        return App.Placement()
+    return App.Placement(getContainerIndex(container.Document).getGlobalPlacement(container))
+
+_trace_hook = None
+
+def setTraceHook(hook):
+    '''setTraceHook(hook): sets a function to be called as hook(text) by getTransformation, 
+    with description of the transform chain. None disables tracing (default). 
+    Example: setTraceHook(App.Console.PrintMessage)'''
+    global _trace_hook
+    _trace_hook = hook
+
+def _traceTransformation(container_from, container_to):
+    (list_leave, list_enter) = getContainerRelativePath(container_from, container_to)
+    steps = []
+    for cnt in list_leave[::-1]:
+        if hasattr(cnt, "Placement"):
+            steps.append(cnt.Name)
+    for cnt in list_enter:
+        if hasattr(cnt, "Placement"):
+            steps.append(cnt.Name+"^-1")
+    _trace_hook("transform chain(first printed = first applied): {chain}\n".format(chain= " -> ".join(steps)))
 
 def getTransformation(container_from, container_to):
     '''getTransformation(container_from, container_to): returns a Placement, which will 
@@ -151,16 +923,16 @@ def getTransformation(container_from, container_to):
         raise TypeError("container_from is not a container!")
     if not isContainer(container_to):
         raise TypeError("container_to is not a container!")
-    (list_leave, list_enter) = getContainerRelativePath(container_from, container_to)
+    if _trace_hook is not None:
+        _traceTransformation(container_from, container_to)
+    
+    plm_from = getGlobalPlacement(container_from)
+    plm_to = getGlobalPlacement(container_to)
+    return plm_to.inverse().multiply(plm_from)
 
-    trf = App.Placement()
-    print "transform chain(first printed = first applied): "
-    for cnt in list_leave[::-1]:
-        if hasattr(cnt, "Placement"):
-            trf = cnt.Placement.multiply(trf)
-            print cnt.Name," -> ",
-    for cnt in list_enter:
-        if hasattr(cnt, "Placement"):
-            trf = cnt.Placement.inverse().multiply(trf)
-            print cnt.Name+"^-1", " -> ",
-    return trf
\ No newline at end of file
+def makeGraphSnapshot(document):
+    '''makeGraphSnapshot(document): returns a compact array-backed copy of dependency graph 
+    and container tree of document, that can be queried, saved and memory-mapped without 
+    touching live objects. See DepGraphSnapshot module. Requires NumPy.'''
+    import DepGraphSnapshot
+    return DepGraphSnapshot.makeSnapshot(document)
@@ -0,0 +1,127 @@
+import FreeCAD as App
+
+class DocumentObserver(object):
+    '''DocumentObserver - the one document observer of AttachmentEditor. It is
+    registered with FreeCAD upon first use, keeps per-document revision counters,
+    and forwards document change notifications to listeners (caches of
+    DepGraphTools and such).
+
+    Listeners are plain objects that may define any of:
+    slotCreatedObject(obj), slotDeletedObject(obj), slotChangedObject(obj, prop),
+    slotDeletedDocument(doc).'''
+
+    def __init__(self):
+        self.listeners = []
+        self.revisions = {} # dict. key = document name, value = number of changes seen so far
+        self.object_revisions = {} # dict. key = (document name, object name), value = value of self.counter at last change of the object
+        self.structure_revisions = {} # dict. key = document name, value = number of objects added or removed so far
+        self.counter = 0 # total number of changes seen, in all documents
+        self.active = False # True if registered with FreeCAD, i.e. notifications do arrive
+
+    def _bump(self, doc, obj = None):
+        self.revisions[doc.Name] = self.revisions.get(doc.Name, 0) + 1
+        self.counter += 1
+        if obj is not None:
+            self.object_revisions[(doc.Name, obj.Name)] = self.counter
+
+    def _forward(self, slot, *args):
+        for listener in list(self.listeners):
+            method = getattr(listener, slot, None)
+            if method is not None:
+                method(*args)
+
+    def _bumpStructure(self, doc):
+        self.structure_revisions[doc.Name] = self.structure_revisions.get(doc.Name, 0) + 1
+
+    def slotCreatedObject(self, obj):
+        self._bump(obj.Document, obj)
+        self._bumpStructure(obj.Document)
+        self._forward("slotCreatedObject", obj)
+
+    def slotDeletedObject(self, obj):
+        self._bump(obj.Document, obj)
+        self._bumpStructure(obj.Document)
+        self._forward("slotDeletedObject", obj)
+
+    def slotChangedObject(self, obj, prop):
+        self._bump(obj.Document, obj)
+        self._forward("slotChangedObject", obj, prop)
+
+    def slotDeletedDocument(self, doc):
+        self._forward("slotDeletedDocument", doc)
+        self.revisions.pop(doc.Name, None)
+        self.structure_revisions.pop(doc.Name, None)
+        for key in [key for key in self.object_revisions if key[0] == doc.Name]:
+            del self.object_revisions[key]
+
+_observer = DocumentObserver()
+
+def _activate():
+    if _observer.active:
+        return True
+    try:
+        App.addDocumentObserver(_observer)
+    except AttributeError:
+        #old FreeCAD, no document observers. Caches relying on notifications must not be used.
+        return False
+    _observer.active = True
+    return True
+
+def addListener(listener):
+    '''addListener(listener): subscribes listener to document change notifications.
+    Returns True if notifications are available, False otherwise (in which case
+    the listener will never be called, and the caller should not cache anything).'''
+    if listener not in _observer.listeners:
+        _observer.listeners.append(listener)
+    return _activate()
+
+def removeListener(listener):
+    '''removeListener(listener): unsubscribes listener. Does nothing if it wasn't subscribed.'''
+    if listener in _observer.listeners:
+        _observer.listeners.remove(listener)
+
+def isActive():
+    '''isActive(): returns True if document change notifications are being received.'''
+    return _activate()
+
+def getRevision(doc):
+    '''getRevision(doc): returns a number that changes every time anything in
+    document doc is changed (object added, removed, or any property changed).
+    Returns None if notifications are not available, which means the revision
+    is unknown and must not be relied upon.'''
+    if not _activate():
+        return None
+    return _observer.revisions.get(doc.Name, 0)
+
+def getStructureRevision(doc):
+    '''getStructureRevision(doc): returns a number that changes every time an object is
+    added to or removed from document doc, but not when properties change. So anything
+    that depends only on which names resolve to which objects stays valid as long as it
+    doesn't change. Returns None if notifications are not available.'''
+    if not _activate():
+        return None
+    return _observer.structure_revisions.get(doc.Name, 0)
+
+def getObjectRevision(obj):
+    '''getObjectRevision(obj): returns a number that changes every time any property 
+    of obj changes (including its Shape, i.e. on recompute). Objects created anew under 
+    the name of a deleted one get a different number. Returns None if notifications 
+    are not available.'''
+    if not _activate():
+        return None
+    return _observer.object_revisions.get((obj.Document.Name, obj.Name), 0)
+
+LINK_PROPERTY_TYPES = ("App::PropertyLink", "App::PropertyExpressionEngine") # TypeId prefixes of properties that contribute to InList/OutList
+
+def isLinkProperty(obj, prop):
+    '''isLinkProperty(obj, prop): returns True if property prop of obj is a link
+    property (including ExpressionEngine, since expressions add links too), i.e. 
+    changing it can change the dependency graph.'''
+    if prop == "ExpressionEngine":
+        return True
+    try:
+        return obj.getTypeIdOfProperty(prop).startswith(LINK_PROPERTY_TYPES)
+    except Exception:
+        #property removed, not a property of obj at all, or old FreeCAD without 
+        #getTypeIdOfProperty. Be pessimistic (caches mark entries stale lazily, so it's cheap).
+        return True
@@ -0,0 +1,95 @@
+'''PlacementArrays - moving whole arrays of points, vectors and placements between
+local coordinate systems of containers, using NumPy.
+
+Points and vectors are (N,3) arrays. Placements are pairs of arrays: positions
+(N,3) and quaternions (N,4), the latter in FreeCAD order (x,y,z,w), same as
+Rotation.Q. Lists of App.Vector / App.Placement are accepted too, but
+converting them is per-item Python work, so keep data in arrays where possible.'''
+
+import numpy
+
+import FreeCAD as App
+
+from DepGraphTools import getTransformation
+
+def quaternionToMatrix(q):
+    '''quaternionToMatrix(q): returns 3x3 rotation matrix of unit quaternion q = (x,y,z,w).'''
+    (x, y, z, w) = q
+    return numpy.array([
+        [1.0 - 2.0*(y*y + z*z),       2.0*(x*y - z*w),       2.0*(x*z + y*w)],
+        [      2.0*(x*y + z*w), 1.0 - 2.0*(x*x + z*z),       2.0*(y*z - x*w)],
+        [      2.0*(x*z - y*w),       2.0*(y*z + x*w), 1.0 - 2.0*(x*x + y*y)]])
+
+def placementToMatrix(plm):
+    '''placementToMatrix(plm): returns 4x4 numpy array of transformation done by App.Placement plm.'''
+    m = numpy.identity(4)
+    m[0:3, 0:3] = quaternionToMatrix(plm.Rotation.Q)
+    m[0:3, 3] = (plm.Base.x, plm.Base.y, plm.Base.z)
+    return m
+
+def getTransformationMatrix(container_from, container_to):
+    '''getTransformationMatrix(container_from, container_to): same as
+    DepGraphTools.getTransformation, but returns a 4x4 numpy array.'''
+    return placementToMatrix(getTransformation(container_from, container_to))
+
+def multiplyQuaternions(q1, q2):
+    '''multiplyQuaternions(q1, q2): returns q1*q2 (rotation q2 applied first). Either
+    argument can be a single quaternion (4,) or an array of them (N,4); (x,y,z,w) order.'''
+    q1 = numpy.asarray(q1, dtype= float)
+    q2 = numpy.asarray(q2, dtype= float)
+    (x1, y1, z1, w1) = (q1[..., 0], q1[..., 1], q1[..., 2], q1[..., 3])
+    (x2, y2, z2, w2) = (q2[..., 0], q2[..., 1], q2[..., 2], q2[..., 3])
+    return numpy.stack([w1*x2 + x1*w2 + y1*z2 - z1*y2,
+                        w1*y2 - x1*z2 + y1*w2 + z1*x2,
+                        w1*z2 + x1*y2 - y1*x2 + z1*w2,
+                        w1*w2 - x1*x2 - y1*y2 - z1*z2], axis= -1)
+
+def vectorsToArray(vectors):
+    '''vectorsToArray(vectors): converts a list of App.Vector (or anything with x,y,z) to
+    (N,3) array. Arrays and lists of triples are passed through numpy.asarray.'''
+    if len(vectors) > 0 and hasattr(vectors[0], "x"):
+        return numpy.array([(v.x, v.y, v.z) for v in vectors], dtype= float)
+    return numpy.asarray(vectors, dtype= float).reshape(-1, 3)
+
+def placementsToArrays(placements):
+    '''placementsToArrays(placements): converts a list of App.Placement to a tuple
+    (positions (N,3), quaternions (N,4)).'''
+    pos = numpy.array([(p.Base.x, p.Base.y, p.Base.z) for p in placements], dtype= float).reshape(-1, 3)
+    quat = numpy.array([p.Rotation.Q for p in placements], dtype= float).reshape(-1, 4)
+    return (pos, quat)
+
+def arraysToPlacements(positions, quaternions):
+    '''arraysToPlacements(positions, quaternions): inverse of placementsToArrays.'''
+    return [App.Placement(App.Vector(*p), App.Rotation(*q)) for (p, q) in zip(positions.tolist(), quaternions.tolist())]
+
+def transformPointsByMatrix(points, m):
+    '''transformPointsByMatrix(points, m): applies 4x4 matrix m to (N,3) array of points.'''
+    points = numpy.asarray(points, dtype= float)
+    return points.dot(m[0:3, 0:3].T) + m[0:3, 3]
+
+def transformPoints(points, container_from, container_to):
+    '''transformPoints(points, container_from, container_to): converts points from local
+    coordinates of container_from to local coordinates of container_to. Returns (N,3) array.'''
+    return transformPointsByMatrix(vectorsToArray(points), getTransformationMatrix(container_from, container_to))
+
+def transformVectors(vectors, container_from, container_to):
+    '''transformVectors(vectors, container_from, container_to): same as transformPoints,
+    but for direction vectors (translation is not applied). Returns (N,3) array.'''
+    m = getTransformationMatrix(container_from, container_to)
+    return vectorsToArray(vectors).dot(m[0:3, 0:3].T)
+
+def transformPlacementArrays(positions, quaternions, container_from, container_to):
+    '''transformPlacementArrays(positions, quaternions, container_from, container_to): converts
+    placements, given as arrays (see placementsToArrays), from local coordinates of
+    container_from to local coordinates of container_to. Returns tuple (positions, quaternions).'''
+    trf = getTransformation(container_from, container_to)
+    new_positions = transformPointsByMatrix(positions, placementToMatrix(trf))
+    new_quaternions = multiplyQuaternions(trf.Rotation.Q, quaternions)
+    return (new_positions, new_quaternions)
+
+def transformPlacements(placements, container_from, container_to):
+    '''transformPlacements(placements, container_from, container_to): same as
+    transformPlacementArrays, but takes and returns lists of App.Placement.'''
+    (pos, quat) = placementsToArrays(placements)
+    (pos, quat) = transformPlacementArrays(pos, quat, container_from, container_to)
+    return arraysToPlacements(pos, quat)
@@ -1,61 +1,41 @@
 import FreeCAD as App
-import Part
-from FreeCAD import Units
-from Units import MilliMetre as mm
-from Units import Degree as deg
-from Units import Quantity as Q
 from FrozenClass import FrozenClass
+import time
+import os
+import tempfile
+from collections import OrderedDict
 
 from TempoVis import TempoVis
 
-from DepGraphTools import getAllDependent
+from DepGraphTools import getDepGraphIndex, getContainer, getGlobalPlacement
+import DocumentObserver
+import AttachmentCache
+import AttachmentBatch
+from AttachmentLinks import StrFromLink, LinkFromStr, StrListFromRefs, RefsFromStrList
 
 if App.GuiUp:
     import FreeCADGui as Gui
     from PySide import QtCore, QtGui
     from FreeCADGui import PySideUic as uic
     
-def StrFromLink(feature, subname):
-    return feature.Name+ ((":"+subname) if subname else "")
-    
-def LinkFromStr(strlink, document):
-    if len(strlink) == 0:
-        return None
-    pieces = strlink.split(":")
-    
-    feature = document.getObject(pieces[0])
-    
-    subname = ""
-    if feature is None:
-        raise ValueError("No object named {name}".format(name= pieces[0]))
-    if len(pieces) == 2:
-        subname = pieces[1]
-    elif len(pieces) > 2:
-        raise ValueError("Failed to parse link (more than one colon encountered)")
-    
-    return (feature,str(subname)) #wrap in str to remove unicode, which confuses assignment to PropertyLinkSubList.
-
-def StrListFromRefs(references):
-    '''input: PropertyLinkSubList. Output: list of strings for UI.'''
-    return [StrFromLink(feature,subelement) for (feature, subelement) in references]
-
-def RefsFromStrList(strings, document):
-    '''input: strings as from UI. Output: list of tuples that can be assigned to PropertyLinkSubList.'''
-    refs = []
-    for st in strings:
-        lnk = LinkFromStr(st, document)
-        if lnk is not None:
-            refs.append(lnk)
-    return refs
-
-def GetSelectionAsLinkSubList():
+def GetSelectionAsLinkSubList(max_count = None, exclude = None):
+    '''GetSelectionAsLinkSubList(max_count = None, exclude = None): returns selection as 
+    list of (object, subname) tuples, at most max_count of them. Selection of object 
+    exclude is skipped.'''
     sel = Gui.Selection.getSelectionEx()
     result = []
     for selobj in sel:
-        for subname in selobj.SubElementNames:
-            result.append((selobj, subname))
-        if len(selobj.SubElementNames) == 0:
-            result.append((selobj, ""))
+        if max_count is not None and len(result) >= max_count:
+            break
+        obj = selobj.Object
+        if obj is exclude:
+            continue
+        subnames = selobj.SubElementNames
+        if len(subnames) == 0:
+            subnames = [""]
+        if max_count is not None:
+            subnames = subnames[0:max_count - len(result)]
+        result.extend([(obj, subname) for subname in subnames])
     return result
     
 class CancelError(Exception):
@@ -63,17 +43,296 @@ class CancelError(Exception):
         self.message = "Canceled by user"
         self.isCancelError = True
         
+class PreviewScheduler(FrozenClass):
+    '''PreviewScheduler - coalesces bursts of preview requests (keystrokes, spin box 
+    ticks) into one evaluation. The first request starts a single-shot timer; 
+    requests arriving before it fires are merged into the same evaluation. 
+    
+    The timer delay adapts to how long evaluation takes (so that event processing 
+    gets a share of time while e.g. an arrow key is held on a spin box over a heavy 
+    shape), but is kept within [min_delay, latency_budget] milliseconds.'''
+    
+    def __define_attributes(self):
+        self.callback = None #function to call to evaluate the preview
+        self.timer = None #single-shot QTimer
+        self.min_delay = 0 #ms. Minimum coalescing window.
+        self.latency_budget = 150 #ms. Maximum delay between a request and evaluation.
+        self.last_duration = 0.0 #ms. How long the last evaluation took.
+        
+        self._freeze()
+    
+    def __init__(self, callback, min_delay = 0, latency_budget = 150):
+        self.__define_attributes()
+        
+        self.callback = callback
+        self.min_delay = min_delay
+        self.latency_budget = latency_budget
+        self.timer = QtCore.QTimer()
+        self.timer.setSingleShot(True)
+        QtCore.QObject.connect(self.timer, QtCore.SIGNAL("timeout()"), self.evaluate)
+    
+    def getDelay(self):
+        '''getDelay(): returns coalescing window for the next request, in ms.'''
+        return int(max(self.min_delay, min(self.latency_budget, self.last_duration)))
+    
+    def request(self):
+        '''request(): schedules an evaluation, unless one is pending already.'''
+        if not self.timer.isActive():
+            self.timer.start(self.getDelay())
+    
+    def cancel(self):
+        '''cancel(): drops pending evaluation, if any.'''
+        self.timer.stop()
+    
+    def evaluate(self):
+        '''evaluate(): evaluates now, and measures how long it took.'''
+        self.timer.stop()
+        t0 = time.time()
+        try:
+            self.callback()
+        finally:
+            self.last_duration = (time.time() - t0) * 1000.0
+
+def _errorText(err):
+    msg = getattr(err, "message", None)
+    if not msg:
+        msg = str(err)
+    return msg
+
+def _findFreeCADCmd():
+    '''_findFreeCADCmd(): returns path to FreeCADCmd executable, or None if not found.'''
+    bindir = os.path.join(App.getHomePath(), "bin")
+    for name in ("FreeCADCmd", "FreeCADCmd.exe", "freecadcmd"):
+        path = os.path.join(bindir, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+class PreviewWorker(FrozenClass):
+    '''PreviewWorker - evaluates previews of attachment editor in a FreeCADCmd process 
+    (see AttachmentBatch.serve), so that heavy suggestModes/calculateAttachedPlacement 
+    don't block the event loop. (A thread wouldn't do, since engine calls hold the GIL.) 
+    The process works on a copy of the document saved to a temporary file; after the 
+    document has changed (see invalidate), the next job saves a new copy.
+    
+    Jobs are plain tuples (see AttachmentBatch.evaluatePreviewJob). One job is evaluated 
+    at a time; a job submitted meanwhile waits, replacing any job that was waiting 
+    before it. Results are delivered on GUI thread, by calling callback(result). Telling 
+    stale results apart (by generation) is up to the callback. If the process dies, 
+    callback(None) is called, and the worker is unusable afterwards.'''
+    
+    def __define_attributes(self):
+        self.document = None
+        self.callback = None
+        self.process = None #QProcess running AttachmentBatch.serve()
+        self.filenames = [] #temporary document copies made so far. The last one is current, if copy_valid.
+        self.copy_valid = False #False if the document has changed since the last copy was saved
+        self.busy = False #True while a job is being evaluated by the process
+        self.queued = None #job waiting for the process to finish the current one
+        self.buffer = "" #output of the process that doesn't make a complete line yet
+        self.alive = False
+        
+        self._freeze()
+    
+    def __init__(self, document, callback):
+        self.__define_attributes()
+        
+        self.document = document
+        self.callback = callback
+    
+    def start(self):
+        '''start(): launches the process. Returns False if FreeCADCmd was not found.'''
+        exe = _findFreeCADCmd()
+        if exe is None:
+            return False
+        self.process = QtCore.QProcess()
+        QtCore.QObject.connect(self.process, QtCore.SIGNAL("readyReadStandardOutput()"), self._readOutput)
+        QtCore.QObject.connect(self.process, QtCore.SIGNAL("finished(int,QProcess::ExitStatus)"), lambda code, status: self._die())
+        QtCore.QObject.connect(self.process, QtCore.SIGNAL("error(QProcess::ProcessError)"), lambda err: self._die())
+        moddir = os.path.dirname(os.path.abspath(AttachmentBatch.__file__))
+        command = "import sys; sys.path.insert(0, {moddir}); import AttachmentBatch; AttachmentBatch.serve()".format(moddir= repr(moddir))
+        self.alive = True
+        self.process.start(exe, ["-c", command])
+        return True
+    
+    def isAlive(self):
+        return self.alive
+    
+    def invalidate(self):
+        '''invalidate(): tells that the document has changed, so the copy is out of date.'''
+        self.copy_valid = False
+    
+    def submit(self, job):
+        '''submit(job): sends job to the process, or queues it if the process is busy.'''
+        if self.busy:
+            self.queued = job
+            return
+        if not self.copy_valid:
+            (handle, filename) = tempfile.mkstemp(suffix= ".FCStd")
+            os.close(handle)
+            self.filenames.append(filename)
+            self.document.saveCopy(filename)
+            self.copy_valid = True
+        self.busy = True
+        line = AttachmentBatch.encodeMessage((self.filenames[-1], job)) + "\n"
+        self.process.write(line.encode("ascii"))
+    
+    def _readOutput(self):
+        self.buffer += bytes(self.process.readAllStandardOutput()).decode("ascii", "replace")
+        lines = self.buffer.split("\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            result = AttachmentBatch.decodeMessage(line)
+            if result is None:
+                continue #console output of FreeCADCmd
+            self.busy = False
+            if self.queued is not None:
+                job = self.queued
+                self.queued = None
+                self.submit(job)
+            self.callback(result)
+    
+    def _die(self):
+        if not self.alive:
+            return
+        self.alive = False
+        self.busy = False
+        self.queued = None
+        self.callback(None)
+    
+    def stop(self):
+        '''stop(): terminates the process, and deletes document copies.'''
+        self.alive = False
+        self.queued = None
+        if self.process is not None:
+            self.process.kill()
+            self.process.waitForFinished(1000)
+        for filename in self.filenames:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        self.filenames = []
+
+_form_class = None #(form class, base class) compiled from TaskAttachmentEditor.ui by uic.loadUiType, once per session. False if loadUiType is not available.
+
+def _makeForm():
+    '''_makeForm(): creates the dialog widget. The .ui file is compiled into a form class 
+    on first use, and the class is reused afterwards, instead of parsing the file for 
+    every opening of the dialog. Widgets are accessible as attributes of the returned 
+    widget, same as with uic.loadUi.'''
+    global _form_class
+    import os
+    ui_path = os.path.dirname(__file__) + os.path.sep + "TaskAttachmentEditor.ui"
+    if _form_class is None:
+        try:
+            _form_class = uic.loadUiType(ui_path)
+        except Exception:
+            _form_class = False
+    if _form_class is False:
+        return uic.loadUi(ui_path)
+    (form_class, base_class) = _form_class
+    form = base_class()
+    ui = form_class()
+    ui.setupUi(form)
+    for (name, widget) in vars(ui).items():
+        setattr(form, name, widget)
+    return form
+
+def _isSamePlacement(plm1, plm2, tolerance = 1e-7):
+    '''_isSamePlacement(plm1, plm2, tolerance = 1e-7): True if placements are equal within 
+    tolerance (quaternions q and -q are the same rotation).'''
+    if plm1.Base.sub(plm2.Base).Length > tolerance:
+        return False
+    dot = sum([a*b for (a, b) in zip(plm1.Rotation.Q, plm2.Rotation.Q)])
+    return abs(abs(dot) - 1.0) <= tolerance
+
+class GhostPreview(FrozenClass):
+    '''GhostPreview - shows a feature at a candidate placement without touching the 
+    document: the displayed subgraph of the feature (the active child of the display 
+    mode switch in ViewObject.RootNode) is added once more to the top of the scene, 
+    under a transform to where the feature would go. So nothing is recomputed, no undo 
+    is recorded, and dependent objects stay where they are, however many there are. 
+    The subgraph is taken below the mode switch, so the ghost stays visible when the 
+    feature itself is hidden.
+    
+    Constructor raises ImportError if pivy is not available, and ValueError if the 
+    feature has no 3D view to show the ghost in, or isn't displayed.'''
+    
+    def __define_attributes(self):
+        self.obj = None
+        self.scenegraph = None #root node of the 3D view the ghost is shown in
+        self.switch = None #SoSwitch that shows/hides the ghost; the node added to scenegraph
+        self.transform = None #SoTransform, global placement of the ghost
+        
+        self._freeze()
+    
+    def __init__(self, obj):
+        self.__define_attributes()
+        
+        from pivy import coin
+        self.obj = obj
+        gui_doc = Gui.getDocument(obj.Document.Name)
+        if obj.ViewObject is None or gui_doc is None or not hasattr(gui_doc.ActiveView, "getSceneGraph"):
+            raise ValueError("No 3D view to show preview of {obj} in".format(obj= obj.Name))
+        root = obj.ViewObject.RootNode
+        display = None
+        for i in range(root.getNumChildren()):
+            child = root.getChild(i)
+            if child.isOfType(coin.SoSwitch.getClassTypeId()):
+                if child.whichChild.getValue() >= 0:
+                    display = child.getChild(child.whichChild.getValue())
+                break
+        if display is None:
+            raise ValueError("{obj} is not displayed, can't show preview of it".format(obj= obj.Name))
+        self.scenegraph = gui_doc.ActiveView.getSceneGraph()
+        self.transform = coin.SoTransform()
+        sep = coin.SoSeparator()
+        sep.addChild(self.transform)
+        sep.addChild(display)
+        self.switch = coin.SoSwitch()
+        self.switch.addChild(sep)
+        self.switch.whichChild = -1 #SO_SWITCH_NONE
+        self.scenegraph.addChild(self.switch)
+    
+    def show(self, placement):
+        '''show(placement): shows the ghost with feature's Placement being placement.'''
+        # ghost is not inside containers, so apply their placement too
+        plm = getGlobalPlacement(getContainer(self.obj)).multiply(placement)
+        self.transform.translation.setValue(tuple(plm.Base))
+        self.transform.rotation.setValue(tuple(plm.Rotation.Q))
+        self.switch.whichChild = 0
+    
+    def hide(self):
+        self.switch.whichChild = -1
+    
+    def isVisible(self):
+        return self.switch.whichChild.getValue() == 0
+    
+    def remove(self):
+        '''remove(): takes the ghost out of the scene.'''
+        self.hide()
+        self.scenegraph.removeChild(self.switch)
+
 class AttachmentEditorTaskPanel(FrozenClass):
     '''The editmode TaskPanel for attachment editing'''
     KEYmode = QtCore.Qt.ItemDataRole.UserRole # Key to use in Item.data(key) to obtain a mode associated with list item
     KEYon = QtCore.Qt.ItemDataRole.UserRole + 1 # Key to use in Item.data(key) to obtain if the mode is valid
     
+    # preview pipeline stages. Each input marks the first stage it affects; updatePreview runs that stage and all later ones.
+    STAGErefs = "refs" # parse reference lines, run suggestor, refill list of modes
+    STAGEmode = "mode" # pick attachment mode
+    STAGEplacement = "placement" # compute attached placement
+    
     def __define_attributes(self):
         self.obj = None #feature being attached
         self.attacher = None #AttachEngine that is being actively used by the dialog. Its parameters are constantly and actively kept in sync with the dialog.
         self.obj_is_attachable = True # False when editing non-attachable objects (alignment, not attachment)
 
         self.last_sugr = None #result of last execution of suggestor
+        self.catalog = None #AttachmentCache.ModeCatalog of attacher type, source of all mode and reference type texts
+        self.mode_items = {} #dict. key = mode, value = QListWidgetItem of listOfModes showing the mode
+        self.mode_item_states = {} #dict. key = mode, value = (text, on, bold) last written to the item
 
         self.form = None #Qt widget of dialog interface
         self.block = False #when True, event handlers return without doing anything (instead of doing-undoing blockSignals to everything)
@@ -84,12 +343,30 @@ class AttachmentEditorTaskPanel(FrozenClass):
         self.auto_next = False #if true, references being selected are appended ("Selecting" state is automatically advanced to next button)
         
         self.tv = None #TempoVis class instance
+        self.preview = None #PreviewScheduler, that calls updatePreview
+        self.dirty = set() #preview stages invalidated by changes since last updatePreview. Empty set means "everything".
+        self.worker = None #PreviewWorker evaluating previews in background. None until a preview is found to be slow (see worker_threshold).
+        self.worker_threshold = 100 #ms. A preview evaluated on GUI thread taking longer than this starts the worker. None if the worker is not to be used.
+        self.generation = 0 #incremented for every preview evaluation; results of older generations are discarded
+        self.in_flight = None #(generation, stages, suggestor cache key) of the job the worker is evaluating for us, or None
+        self.ghost = None #GhostPreview showing the previewed placement. If None, preview is done by writing obj.Placement.
+        self.new_placement = None #previewed placement, written to obj on Apply/OK. None if not attached.
+        self.forbidden = None #set of names of objects that can't be used as references (obj and everything depending on it). None if out of date.
+        self.forbidden_cacheable = False #False if document notifications are unavailable, then forbidden set is remade for every selection batch
+        self.selection_queue = [] #list of (docname, objname, subname) selected since last processSelection
+        self.selection_timer = None #zero-delay single-shot QTimer, that calls processSelection
+        self.startup_times = OrderedDict() #key = stage of dialog opening, value = time it took, in ms. See getStartupReport.
+        self.startup_mark = 0.0 #time.time() when the last stage of opening ended
 
         self._freeze()
     
     def __init__(self, obj_to_attach, bool_take_selection):
         
         self.__define_attributes()
+        self.startup_mark = time.time()
+        
+        import Part
+        self.markStartupStage("import Part")
         
         self.obj = obj_to_attach
         if hasattr(obj_to_attach,"Attacher"):
@@ -112,8 +389,11 @@ class AttachmentEditorTaskPanel(FrozenClass):
             if mb.clickedButton() is btnAbort:
                 raise CancelError()
         
-        import os
-        self.form=uic.loadUi(os.path.dirname(__file__) + os.path.sep + "TaskAttachmentEditor.ui")
+        self.catalog = AttachmentCache.getModeCatalog(self.attacher)
+        self.markStartupStage("attacher")
+        
+        self.form = _makeForm()
+        self.markStartupStage("form")
         # self.form.setWindowIcon(QtGui.QIcon(":/icons/PartDesign_InternalExternalGear.svg"))
         self.form.setWindowTitle("Attachment")
         
@@ -133,6 +413,8 @@ class AttachmentEditorTaskPanel(FrozenClass):
                                     self.form.superplacementRoll]
                            
         self.block = False
+        
+        self.preview = PreviewScheduler(self.updatePreview)
                            
         for i in range(len(self.refLines)):
             QtCore.QObject.connect(self.refLines[i], QtCore.SIGNAL("textEdited(QString)"), lambda txt, i=i: self.lineRefChanged(i,txt))
@@ -148,17 +430,15 @@ class AttachmentEditorTaskPanel(FrozenClass):
         QtCore.QObject.connect(self.form.listOfModes, QtCore.SIGNAL("itemSelectionChanged()"), self.modeSelected)
         
         self.obj.Document.openTransaction("Edit attachment of {feat}".format(feat= self.obj.Name))
+        self.markStartupStage("connections")
         
 
         self.readParameters()
+        self.markStartupStage("readParameters")
 
         
         if len(self.attacher.References) == 0 and bool_take_selection:
-            sel = GetSelectionAsLinkSubList()
-            for i in range(len(sel))[::-1]:
-                if sel[i][0] is obj_to_attach:
-                    sel.pop(i)
-            self.attacher.References = sel
+            self.attacher.References = GetSelectionAsLinkSubList(max_count= len(self.refLines), exclude= obj_to_attach)
         if len(self.attacher.References) == 0:
             self.i_active_ref = 0
             self.auto_next = True
@@ -166,15 +446,47 @@ class AttachmentEditorTaskPanel(FrozenClass):
             self.i_active_ref = -1
             self.auto_next = False
 
+        self.selection_timer = QtCore.QTimer()
+        self.selection_timer.setSingleShot(True)
+        self.selection_timer.setInterval(0)
+        QtCore.QObject.connect(self.selection_timer, QtCore.SIGNAL("timeout()"), self.processSelection)
+        self.forbidden_cacheable = DocumentObserver.addListener(self)
         Gui.Selection.addObserver(self)
+        self.markStartupStage("observers")
+        
+        # computed here rather than on first selection: the dependent closure goes to DepGraphIndex, and hide_all_dependent below reuses it
+        self.getForbidden()
+        self.markStartupStage("forbidden")
 
+        self.tv = TempoVis(self.obj.Document)
+        with self.tv.batch():
+            self.tv.hide_all_dependent(self.obj)
+            self.tv.show(self.obj)
+            self.tv.show([obj for (obj,subname) in self.attacher.References])
+        self.markStartupStage("TempoVis")
+        
+        try:
+            self.ghost = GhostPreview(self.obj) #after obj was shown, so that its display mode subgraph is active
+        except (ImportError, ValueError):
+            self.ghost = None #no pivy or no 3D view; fall back to previewing by modifying the object
         self.updatePreview()
         self.updateRefButtons()
-        
-        self.tv = TempoVis(self.obj.Document)
-        self.tv.hide_all_dependent(self.obj)
-        self.tv.show(self.obj)
-        self.tv.show([obj for (obj,subname) in self.attacher.References])
+        self.markStartupStage("preview")
+        App.Console.PrintLog(self.getStartupReport())
+    
+    def markStartupStage(self, stage):
+        '''markStartupStage(stage): records time since the previous stage of dialog opening ended.'''
+        t = time.time()
+        self.startup_times[stage] = (t - self.startup_mark) * 1000.0
+        self.startup_mark = t
+    
+    def getStartupReport(self):
+        '''getStartupReport(): returns text with times of stages of dialog opening. It is also 
+        printed to report view as log message (visible if logging is enabled).'''
+        lines = ["Attachment editor opened in {total:.1f} ms:".format(total= sum(self.startup_times.values()))]
+        for stage in self.startup_times:
+            lines.append("  {stage}: {t:.1f} ms".format(stage= stage, t= self.startup_times[stage]))
+        return "\n".join(lines) + "\n"
     
     # task dialog handling
     def getStandardButtons(self):
@@ -182,13 +494,16 @@ class AttachmentEditorTaskPanel(FrozenClass):
     
     def clicked(self,button):
         if button == QtGui.QDialogButtonBox.Apply:
+            self.finishPreview()
             if self.obj_is_attachable:
                 self.writeParameters()
-            updatePreview()
+            self.writePlacement()
 
     def accept(self):
+        self.finishPreview()
         if self.obj_is_attachable:
             self.writeParameters()
+        self.writePlacement()
         self.obj.Document.commitTransaction()
         self.cleanUp()
         Gui.Control.closeDialog()
@@ -201,13 +516,39 @@ class AttachmentEditorTaskPanel(FrozenClass):
 
     #selectionObserver stuff
     def addSelection(self,docname,objname,subname,pnt):
-        i = self.i_active_ref
-        if i < 0:
+        if self.i_active_ref < 0:
             #not selecting any reference
             return
+        # box selection fires an event per subelement. Queue them, and deal with all at once when the burst is over.
+        self.selection_queue.append((docname, objname, subname))
+        if not self.selection_timer.isActive():
+            self.selection_timer.start()
+    
+    def processSelection(self):
+        '''processSelection(): assigns references from queued selection events. Runs one 
+        validation pass and requests one preview for the whole batch.'''
+        queue = self.selection_queue
+        self.selection_queue = []
+        changed = False
+        for (docname, objname, subname) in queue:
+            if self.i_active_ref < 0:
+                break
+            changed = self.takeSelection(docname, objname, subname) or changed
+        if changed:
+            self.dirty.add(self.STAGErefs)
+            self.preview.request()
+        self.updateRefButtons()
+    
+    def takeSelection(self, docname, objname, subname):
+        '''takeSelection(docname, objname, subname): assigns one selected item to the active 
+        reference line. Returns True if a line was changed.'''
+        i = self.i_active_ref
         if i > 0 and self.auto_next:
-            prevref = LinkFromStr( self.refLines[i-1].text(), self.obj.Document )
-            if prevref[0].Name == objname and subname == "":
+            try:
+                prevref = AttachmentCache.getLinkCache().resolve( self.refLines[i-1].text(), self.obj.Document )
+            except ValueError:
+                prevref = None
+            if prevref is not None and prevref[0].Name == objname and subname == "":
                 # whole object was selected by double-clicking
                 # its subelement was already written to line[i-1], so we decrease i to overwrite the lineRefChanged
                 i -= 1
@@ -215,29 +556,62 @@ class AttachmentEditorTaskPanel(FrozenClass):
             # all 4 references have been selected, finish
             assert(self.auto_next)
             self.i_active_ref = -1
-            self.updateRefButtons()
-            return
-        if i > -1:
-            # assign the selected reference
-            if objname == self.obj.Name:
-                self.form.message.setText("Ignored. Can't attach object to itself!")
-                return
-            if App.getDocument(docname).getObject(objname) in getAllDependent(self.obj):
-                self.form.message.setText("{obj1} depends on object being attached, can't use it for attachment".format(obj1= objname))
-                return
+            return False
+        # assign the selected reference
+        if objname == self.obj.Name:
+            self.form.message.setText("Ignored. Can't attach object to itself!")
+            return False
+        if docname == self.obj.Document.Name and objname in self.getForbidden():
+            self.form.message.setText("{obj1} depends on object being attached, can't use it for attachment".format(obj1= objname))
+            return False
 
-            self.refLines[i].setText( StrFromLink(App.getDocument(docname).getObject(objname), subname) )
-            self.lineRefChanged(i,"")
-            if self.auto_next:
-                i += 1
+        self.refLines[i].setText( StrFromLink(App.getDocument(docname).getObject(objname), subname) )
+        if self.auto_next:
+            i += 1
         self.i_active_ref = i
-        self.updateRefButtons()
+        return True
+    
+    def getForbidden(self):
+        '''getForbidden(): returns set of names of objects that can't be referenced (obj, and 
+        objects that depend on it). Made when the dialog opens, and made again after the 
+        document reports a change of links.'''
+        if self.forbidden is None:
+            forbidden = set(getDepGraphIndex(self.obj.Document).getDependentNames(self.obj))
+            forbidden.add(self.obj.Name)
+            if not self.forbidden_cacheable:
+                return forbidden
+            self.forbidden = forbidden
+        return self.forbidden
+    
+    #document notifications (see DocumentObserver)
+    def slotCreatedObject(self, obj):
+        if obj.Document is self.obj.Document:
+            self.forbidden = None
+            self.invalidateWorkerCopy()
+    
+    def slotDeletedObject(self, obj):
+        if obj.Document is self.obj.Document:
+            self.forbidden = None
+            self.invalidateWorkerCopy()
+    
+    def slotChangedObject(self, obj, prop):
+        if obj.Document is self.obj.Document and DocumentObserver.isLinkProperty(obj, prop):
+            self.forbidden = None
+        if obj.Document is self.obj.Document and obj is not self.obj:
+            # parameters of obj itself are sent with every job
+            self.invalidateWorkerCopy()
+    
+    def invalidateWorkerCopy(self):
+        if self.worker is not None:
+            self.worker.invalidate()
     
     # slots
 
     def superplacementChanged(self, index, value):
         if self.block:
             return
+        from FreeCAD import Units
+        (Q, mm, deg) = (Units.Quantity, Units.MilliMetre, Units.Degree)
         plm = self.attacher.SuperPlacement
         pos = plm.Base
         if index==0:
@@ -263,19 +637,28 @@ class AttachmentEditorTaskPanel(FrozenClass):
         
         self.attacher.SuperPlacement = plm
         
-        self.updatePreview()
+        self.dirty.add(self.STAGEplacement)
+        self.preview.request()
 
     def checkBoxFlipClicked(self):
         if self.block:
             return
         self.attacher.Reverse = self.form.checkBoxFlip.isChecked()
-        self.updatePreview()
+        self.dirty.add(self.STAGEplacement)
+        self.preview.request()
 
     def lineRefChanged(self, index, value):
         if self.block:
             return
-        # not parsing links here, because doing it in updatePreview will display error message
-        self.updatePreview()
+        self.dirty.add(self.STAGErefs)
+        try:
+            # catches typos (unknown object, Face37 of a box) right away, without running attacher
+            AttachmentCache.getLinkCache().resolve(value, self.obj.Document)
+        except ValueError as err:
+            self.preview.cancel()
+            self.showPreviewResult(None, _errorText(err))
+            return
+        self.preview.request()
 
     def refButtonClicked(self, index):
         if self.block:
@@ -293,18 +676,29 @@ class AttachmentEditorTaskPanel(FrozenClass):
         if self.block: 
             return
         self.attacher.Mode = self.getCurrentMode()        
-        self.updatePreview()
+        self.dirty.add(self.STAGEmode)
+        self.preview.request()
         
     #internal methods
     def writeParameters(self):
         "Transfer from the dialog to the object" 
         self.attacher.writeParametersToFeature(self.obj)
+    
+    def writePlacement(self):
+        "Move the object to the previewed placement (when previewing with ghost, the object is not touched until now)"
+        if self.ghost is None:
+            return #already written by preview
+        if self.new_placement is not None:
+            self.obj.Placement = self.new_placement
+        self.showGhost(None) #the object itself is there now
         
     def readParameters(self):
         "Transfer from the object to the dialog"
         if self.obj_is_attachable:
             self.attacher.readParametersFromFeature(self.obj)
         
+        from FreeCAD import Units
+        (mm, deg) = (Units.MilliMetre, Units.Degree)
         plm = self.attacher.SuperPlacement
         try:
             old_selfblock = self.block 
@@ -327,68 +721,69 @@ class AttachmentEditorTaskPanel(FrozenClass):
             self.block = old_selfblock
         
     def parseAllRefLines(self):
-        self.attacher.References = RefsFromStrList([le.text() for le in self.refLines], self.obj.Document)
+        self.attacher.References = AttachmentCache.resolveLinks([le.text() for le in self.refLines], self.obj.Document)
     
     def updateListOfModes(self):
-        '''needs suggestor to have been called, and assigned to self.last_sugr'''
+        '''needs suggestor to have been called, and assigned to self.last_sugr. 
+        Reconciles the list with the suggestion, instead of refilling it: items are kept 
+        in self.mode_items, and only what differs from the recorded item state is written.'''
         try:
             old_selfblock = self.block 
             self.block = True
             list_widget = self.form.listOfModes
-            list_widget.clear()
             sugr = self.last_sugr
-            # add valid modes
+            # wanted rows: (mode, text, on, bold). Valid modes first, then potential modes.
+            rows = []
+            seen = set()
             for m in sugr["allApplicableModes"]:
-                item = QtGui.QListWidgetItem()
-                txt = self.attacher.getModeInfo(m)["UserFriendlyName"]
-                item.setText(txt)
-                item.setData(self.KEYmode,m)
-                item.setData(self.KEYon,True)
-                if m == sugr["bestFitMode"]:
-                    f = item.font()
-                    f.setBold(True)
-                    item.setFont(f)
-                list_widget.addItem(item)
-                item.setSelected(self.attacher.Mode == m)
-            # add potential modes
+                if not (m in seen):
+                    seen.add(m)
+                    rows.append((m, self.catalog.getModeName(m), True, m == sugr["bestFitMode"]))
             for m in sugr["reachableModes"].keys():
-                item = QtGui.QListWidgetItem()
-                txt = self.attacher.getModeInfo(m)["UserFriendlyName"]
-                listlistrefs = sugr["reachableModes"][m]
-                if len(listlistrefs) == 1:
-                    listrefs_userfriendly = [self.attacher.getRefTypeInfo(t)["UserFriendlyName"] for t in listlistrefs[0]]
-                    txt = "{mode} (add {morerefs})".format(mode= txt, 
-                                                           morerefs= u"+".join(listrefs_userfriendly))
-                else:
-                    txt = "{mode} (add more references)".format(mode= txt)
-                item.setText(txt)
-                item.setData(self.KEYmode,m)
-                item.setData(self.KEYon,True)
-                if m == sugr["bestFitMode"]:
+                if not (m in seen):
+                    seen.add(m)
+                    rows.append((m, self.catalog.getReachableModeText(m, sugr["reachableModes"][m]), False, m == sugr["bestFitMode"]))
+            
+            # drop items of modes that are gone
+            for m in [m for m in self.mode_items if not (m in seen)]:
+                item = self.mode_items.pop(m)
+                del self.mode_item_states[m]
+                list_widget.takeItem(list_widget.row(item))
+            
+            for irow in range(len(rows)):
+                (m, txt, on, bold) = rows[irow]
+                item = self.mode_items.get(m)
+                state = self.mode_item_states.get(m)
+                if item is None:
+                    item = QtGui.QListWidgetItem()
+                    item.setData(self.KEYmode,m)
+                    item.setToolTip(self.catalog.getModeTooltip(m))
+                    self.mode_items[m] = item
+                    list_widget.insertItem(irow, item)
+                elif list_widget.row(item) != irow:
+                    list_widget.takeItem(list_widget.row(item))
+                    list_widget.insertItem(irow, item)
+                
+                if state is None or state[0] != txt:
+                    item.setText(txt)
+                if state is None or state[1] != on:
+                    item.setData(self.KEYon,on)
+                    f = item.flags()
+                    if on:
+                        f = f | (QtCore.Qt.ItemFlag.ItemIsEnabled | QtCore.Qt.ItemFlag.ItemIsSelectable)
+                    else:
+                        #disable this item
+                        f = f & ~(QtCore.Qt.ItemFlag.ItemIsEnabled | QtCore.Qt.ItemFlag.ItemIsSelectable)
+                    item.setFlags(f)
+                if state is None or state[2] != bold:
                     f = item.font()
-                    f.setBold(True)
+                    f.setBold(bold)
                     item.setFont(f)
+                self.mode_item_states[m] = (txt, on, bold)
                 
-                #disable this item
-                f = item.flags()
-                f = f & ~(QtCore.Qt.ItemFlag.ItemIsEnabled | QtCore.Qt.ItemFlag.ItemIsSelectable)
-                item.setFlags(f)
-                
-                list_widget.addItem(item)
-            
-            # re-scan the list to fill in tooltips
-            for item in list_widget.findItems("", QtCore.Qt.MatchContains):
-                m = item.data(self.KEYmode)
-                on = item.data(self.KEYon)
-
-                mi = self.attacher.getModeInfo(m)
-                cmb = []
-                for refstr in mi["ReferenceCombinations"]:
-                    refstr_userfriendly = [self.attacher.getRefTypeInfo(t)["UserFriendlyName"] for t in refstr]
-                    cmb.append(u", ".join(refstr_userfriendly))
-                tip = u"{docu}\n\nReference combinations:\n{combinations}".format(docu=mi["BriefDocu"], combinations= u"\n".join(cmb) )
-
-                item.setToolTip(tip)
+                selected = on and self.attacher.Mode == m
+                if item.isSelected() != selected:
+                    item.setSelected(selected)
 
         finally:
             self.block = old_selfblock
@@ -406,7 +801,7 @@ class AttachmentEditorTaskPanel(FrozenClass):
                 if self.last_sugr is not None:
                     typestr = self.last_sugr["references_Types"]
                     if i < len(typestr):
-                        typ = self.attacher.getRefTypeInfo(typestr[i])["UserFriendlyName"]
+                        typ = self.catalog.getRefTypeName(typestr[i])
                 btn.setText("Selecting..." if self.i_active_ref == i else typ)
         finally:
             self.block = old_selfblock
@@ -424,35 +819,175 @@ class AttachmentEditorTaskPanel(FrozenClass):
         # no suggested mode. Return current, so it doesn't change
         return self.attacher.Mode
     
-    def updatePreview(self):
-        new_plm = None
+    def updatePreview(self, synchronous = False):
+        '''updatePreview(synchronous = False): runs the stages of preview pipeline invalidated 
+        since last time (see self.dirty), or all of them if nothing was marked (explicit call). 
+        Reference lines are parsed on GUI thread. Suggestor and placement computation are 
+        sent to the worker if it is running and synchronous is False; the result comes 
+        to applyPreviewResult. Either way, the job the worker is busy with becomes stale, 
+        and its stages are redone.'''
+        stages = self.dirty if len(self.dirty) > 0 else set([self.STAGErefs, self.STAGEmode, self.STAGEplacement])
+        self.dirty = set()
+        if self.in_flight is not None:
+            stages |= self.in_flight[1]
+            self.in_flight = None
+        self.generation += 1
+        do_refs = self.STAGErefs in stages
+        do_mode = do_refs or self.STAGEmode in stages
+        use_worker = not synchronous and self.worker is not None and self.worker.isAlive()
         
+        new_plm = None
+        error = None
+        t0 = time.time()
         try:
-            self.parseAllRefLines()
-            self.last_sugr = self.attacher.suggestModes()
-            if self.last_sugr["message"] == "LinkBroken":
-                raise ValueError("Failed to resolve links. {err}".format(err= self.last_sugr["error"]))
-                
-            self.updateListOfModes()
+            sugr_key = None
+            suggest = False
+            if do_refs:
+                self.parseAllRefLines()
+                sugr_key = AttachmentCache.getSuggestorCache().getKey(self.attacher)
+                sugr = AttachmentCache.getSuggestorCache().lookup(sugr_key)
+                if sugr is None and not use_worker:
+                    sugr = self.attacher.suggestModes()
+                    AttachmentCache.getSuggestorCache().store(sugr_key, sugr)
+                if sugr is None:
+                    suggest = True #worker will run suggestor, and choose mode
+                else:
+                    self.takeSuggestion(sugr)
+            elif do_mode:
+                self.attacher.Mode = self.getCurrentMode()
             
-            self.attacher.Mode = self.getCurrentMode()
+            if use_worker:
+                job = (self.generation,
+                       AttachmentBatch.AttachmentSpec(self.obj.Name, 
+                                                      StrListFromRefs(self.attacher.References), 
+                                                      mode= self.attacher.Mode, 
+                                                      superplacement= self.attacher.SuperPlacement, 
+                                                      reverse= self.attacher.Reverse).toTuple(),
+                       AttachmentBatch.tupleFromPlacement(self.obj.Placement),
+                       suggest)
+                self.worker.submit(job)
+                self.in_flight = (self.generation, stages, sugr_key if suggest else None)
+                self.form.message.setText("Computing...")
+                return
             
             new_plm = self.attacher.calculateAttachedPlacement(self.obj.Placement)
-            if new_plm is None:
-                self.form.message.setText("Not attached")
-            else:
-                self.form.message.setText("Attached")
-                self.obj.Placement = new_plm
         except Exception as err:
-            self.form.message.setText("Error: {err}".format(err= err.message))
+            error = _errorText(err)
+            # attacher may be left half-updated. Redo everything next time, so that the error doesn't get hidden.
+            self.dirty.add(self.STAGErefs)
+        self.showPreviewResult(new_plm, error)
+        
+        if self.worker is None and self.worker_threshold is not None and (time.time() - t0) * 1000.0 > self.worker_threshold:
+            self.startWorker()
+    
+    def takeSuggestion(self, sugr):
+        '''takeSuggestion(sugr): makes suggestor result sugr current: refills list of modes, 
+        and picks the mode. Raises ValueError if references couldn't be resolved.'''
+        if sugr["message"] == "LinkBroken":
+            raise ValueError("Failed to resolve links. {err}".format(err= sugr["error"]))
+        self.last_sugr = sugr
+        self.updateListOfModes()
+        self.updateRefButtons()
+        self.attacher.Mode = self.getCurrentMode()
+    
+    def applyPreviewResult(self, result):
+        '''applyPreviewResult(result): takes result of a job done by the worker (see 
+        AttachmentBatch.evaluatePreviewJob) to the dialog. Results of stale generations are 
+        discarded. result is None if the worker died; then the preview is redone on GUI thread.'''
+        if result is None:
+            self.worker_threshold = None
+            if self.in_flight is not None:
+                self.dirty |= self.in_flight[1]
+                self.in_flight = None
+                self.preview.request()
+            return
+        (generation, sugr, mode, plm, error) = result
+        if self.in_flight is None or generation != self.in_flight[0]:
+            return #stale
+        sugr_key = self.in_flight[2]
+        self.in_flight = None
+        if sugr is not None:
+            AttachmentCache.getSuggestorCache().store(sugr_key, sugr)
+        new_plm = None
+        try:
+            if sugr is not None:
+                self.takeSuggestion(sugr)
+            if mode is not None:
+                self.attacher.Mode = str(mode)
+            if plm is not None:
+                new_plm = AttachmentBatch.placementFromTuple(plm)
+        except Exception as err:
+            error = _errorText(err)
+        if error is not None:
+            self.dirty.add(self.STAGErefs)
+        self.showPreviewResult(new_plm, error)
+    
+    def startWorker(self):
+        '''startWorker(): starts evaluating previews in background (see PreviewWorker). Not 
+        done for objects that are not attachable, since the worker attaches a copy of the 
+        feature.'''
+        if not (self.obj_is_attachable and hasattr(self.obj, "AttacherType")):
+            self.worker_threshold = None
+            return
+        self.worker = PreviewWorker(self.obj.Document, self.applyPreviewResult)
+        if not self.worker.start():
+            self.worker = None
+            self.worker_threshold = None
+    
+    def finishPreview(self):
+        '''finishPreview(): brings the preview up to date right away (before parameters are 
+        written): does the pending evaluation, and the one the worker is busy with, on GUI 
+        thread.'''
+        self.preview.cancel()
+        if len(self.dirty) > 0 or self.in_flight is not None:
+            self.updatePreview(synchronous= True)
+    
+    def showPreviewResult(self, new_plm, error):
+        if error is not None:
+            self.form.message.setText("Error: {err}".format(err= error))
+            new_plm = None
+        elif new_plm is None:
+            self.form.message.setText("Not attached")
+        else:
+            self.form.message.setText("Attached")
+        
+        self.new_placement = new_plm
+        if self.ghost is None:
+            if new_plm is not None:
+                self.obj.Placement = new_plm
+        else:
+            self.showGhost(new_plm)
         
         if new_plm is not None:
             self.form.groupBox_superplacement.setTitle("Extra placement:")
         else:
             self.form.groupBox_superplacement.setTitle("Extra placement (inactive - not attached):")
 
+    def showGhost(self, new_plm):
+        '''showGhost(new_plm): shows the ghost at new_plm, and hides the object itself 
+        meanwhile. If new_plm is None, or the object is there already, shows the object 
+        instead of the ghost.'''
+        if new_plm is not None and not _isSamePlacement(new_plm, self.obj.Placement):
+            self.ghost.show(new_plm)
+        else:
+            self.ghost.hide()
+        with self.tv.batch():
+            if self.ghost.isVisible():
+                self.tv.hide(self.obj)
+            else:
+                self.tv.show(self.obj)
+    
     def cleanUp(self):
         '''stuff that needs to be done when dialog is closed.'''
+        self.preview.cancel()
+        if self.worker is not None:
+            self.worker.stop()
+        self.selection_timer.stop()
+        self.selection_queue = []
+        DocumentObserver.removeListener(self)
+        if self.ghost is not None:
+            self.showGhost(None)
+            self.ghost.remove()
         Gui.Selection.removeObserver(self)
         self.tv.restore()
         
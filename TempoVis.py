@@ -1,10 +1,28 @@
 import FreeCAD as App
+from collections import OrderedDict
+from contextlib import contextmanager
 if App.GuiUp:
     import FreeCADGui as Gui
 
 from FrozenClass import FrozenClass
 
-from DepGraphTools import getAllDependencies, getAllDependent, isContainer
+from DepGraphTools import iterDependencies, iterDependent, isContainer, getContainerChain, getContainerContents, getDepGraphIndex
+
+_UNSET = object() # placeholder in TempoVis.originals for values that were not recorded
+
+def _iterSubtrees(containers):
+    '''_iterSubtrees(containers): yields each container followed by everything inside it, 
+    recursively, outer before inner. Each object is yielded once.'''
+    seen = set()
+    stack = list(reversed(containers))
+    while len(stack) > 0:
+        obj = stack.pop()
+        if obj.Name in seen:
+            continue
+        seen.add(obj.Name)
+        yield obj
+        if isContainer(obj):
+            stack.extend(reversed(getContainerContents(obj)))
 
 class TempoVis(FrozenClass):
     '''TempoVis - helper object to save visibilities of objects before doing 
@@ -12,12 +30,28 @@ class TempoVis(FrozenClass):
     then restoring all visibilities after editing.
     
     Constructors:
-    TempoVis(document): creates a new TempoVis. Supplying document is mandatory. Objects not belonging to the document can't be modified via TempoVis.'''
+    TempoVis(document): creates a new TempoVis. Supplying document is mandatory. Objects not belonging to the document can't be modified via TempoVis.
+
+    Batching:
+    with tv.batch():
+        tv.hide_all_dependent(feat)
+        tv.show(feat)
+    collects the changes, and writes only the net result when the with-block ends
+    (each property at most once, and only if the value actually changes).
+
+    Original values are kept in per-property lists indexed by object index (order
+    of first modification). restore() only visits properties that were actually
+    changed, and writes only those that still differ from the original.'''
     
     def __define_attributes(self):
-        self.data = {} # dict. key = ("Object","Property"), value = original value of the property
+        self.objects = [] # list of document objects modified so far. Index in this list is the object index.
+        self.obj_index = {} # dict. key = object Name, value = object index
+        self.originals = {} # dict. key = "Property", value = list of original values of the property, by object index (_UNSET if not recorded)
+        self.changed = set() # set of (object index, "Property") that were actually written to
         self.document = None
         self.restore_on_delete = False
+        self.batch_depth = 0 # >0 while inside batch(). Changes are written when the outermost batch ends.
+        self.pending = OrderedDict() # key = ("Object","Property"), value = (document object, new value). Changes collected by batch.
         
         self._freeze()
     
@@ -30,20 +64,116 @@ class TempoVis(FrozenClass):
         '''modifyVPProperty(self, doc_obj_or_list, prop_name, new_value): modifies 
         prop_name property of ViewProvider of doc_obj_or_list, and remembers 
         original value of the property. Original values will be restored upon 
-        TempoVis deletion, or call to restore().'''
+        TempoVis deletion, or call to restore(). Inside batch(), the change is
+        only recorded, and is written when the batch ends.'''
         
         if App.GuiUp:
             if type(doc_obj_or_list) is not list:
                 doc_obj_or_list = [doc_obj_or_list]
-            for doc_obj in doc_obj_or_list:
+            self._modifyMany(doc_obj_or_list, prop_name, new_value)
+
+    def _modifyMany(self, doc_objects, prop_name, new_value, skip_containers = False):
+        '''_modifyMany(doc_objects, prop_name, new_value, skip_containers = False): body of
+        modifyVPProperty. doc_objects can be any iterable (e.g. a generator); objects are
+        processed as they come, without building lists.'''
+        if not App.GuiUp:
+            return
+        if self.batch_depth > 0:
+            pending = self.pending
+            for doc_obj in doc_objects:
+                if skip_containers and isContainer(doc_obj):
+                    continue
                 if doc_obj.Document is not self.document:  #ignore objects from other documents
                     raise ValueError("Document object to be modified does not belong to document TempoVis was made for.")
-                oldval = getattr(doc_obj.ViewObject, prop_name)
-                setattr(doc_obj.ViewObject, prop_name, new_value)
-                #assert(getattr(doc_obj.ViewObject, prop_name)==new_value)
-                if not self.data.has_key((doc_obj.Name,prop_name)):
-                    self.data[(doc_obj.Name,prop_name)] = oldval
-                    self.restore_on_delete = True
+                key = (doc_obj.Name,prop_name)
+                pending.pop(key, None) #so that writes are done in order of last request
+                pending[key] = (doc_obj, new_value)
+        else:
+            self._write(doc_objects, prop_name, new_value, skip_containers)
+
+    def _write(self, doc_objects, prop_name, new_value, skip_containers = False):
+        '''_write(doc_objects, prop_name, new_value, skip_containers = False): writes the
+        value right away, recording originals. Attribute lookups are hoisted out of the
+        loop, since this runs once per object of the model.'''
+        document = self.document
+        objects = self.objects
+        obj_index = self.obj_index
+        changed = self.changed
+        originals = self.originals.setdefault(prop_name, [])
+        recorded = False
+        for doc_obj in doc_objects:
+            if skip_containers and isContainer(doc_obj):
+                continue
+            if doc_obj.Document is not document:  #ignore objects from other documents
+                raise ValueError("Document object to be modified does not belong to document TempoVis was made for.")
+            i = obj_index.get(doc_obj.Name)
+            if i is None:
+                i = len(objects)
+                objects.append(doc_obj)
+                obj_index[doc_obj.Name] = i
+            if len(originals) <= i:
+                originals.extend([_UNSET] * (i + 1 - len(originals)))
+            vp = doc_obj.ViewObject
+            oldval = getattr(vp, prop_name)
+            if originals[i] is _UNSET:
+                originals[i] = oldval
+                recorded = True
+            if oldval != new_value:
+                setattr(vp, prop_name, new_value)
+                changed.add((i, prop_name))
+        if recorded:
+            self.restore_on_delete = True
+
+    def _record(self, doc_objects, prop_name):
+        '''_record(doc_objects, prop_name): records original values of the property as if it 
+        was modified, without writing anything, so that restore() brings them back. For 
+        properties that change as a side effect (e.g. Visibility of contents of a group 
+        being hidden). Values recorded before are kept.'''
+        if not App.GuiUp:
+            return
+        objects = self.objects
+        obj_index = self.obj_index
+        originals = self.originals.setdefault(prop_name, [])
+        for doc_obj in doc_objects:
+            i = obj_index.get(doc_obj.Name)
+            if i is None:
+                i = len(objects)
+                objects.append(doc_obj)
+                obj_index[doc_obj.Name] = i
+            if len(originals) <= i:
+                originals.extend([_UNSET] * (i + 1 - len(originals)))
+            if originals[i] is _UNSET:
+                originals[i] = getattr(doc_obj.ViewObject, prop_name)
+                self.changed.add((i, prop_name))
+                self.restore_on_delete = True
+
+    def beginBatch(self):
+        '''beginBatch(): starts collecting changes instead of writing them. See batch().'''
+        self.batch_depth += 1
+
+    def endBatch(self):
+        '''endBatch(): ends batch started by beginBatch(). When the outermost batch ends,
+        the net result of collected changes is written.'''
+        if self.batch_depth == 0:
+            raise ValueError("endBatch() without beginBatch()")
+        self.batch_depth -= 1
+        if self.batch_depth > 0:
+            return
+        pending = self.pending
+        self.pending = OrderedDict()
+        for key in pending:
+            (doc_obj, new_value) = pending[key]
+            self._write([doc_obj], key[1], new_value)
+
+    @contextmanager
+    def batch(self):
+        '''batch(): context manager. Changes done within it are collected, and their
+        net result is written when it ends. Usage: with tv.batch(): ...'''
+        self.beginBatch()
+        try:
+            yield self
+        finally:
+            self.endBatch()
     
     def show(self, doc_obj_or_list):
         '''show(doc_obj_or_list): shows objects (sets their Visibility to True). doc_obj_or_list can be a document object, or a list of document objects'''
@@ -53,35 +183,94 @@ class TempoVis(FrozenClass):
         '''hide(doc_obj_or_list): hides objects (sets their Visibility to False). doc_obj_or_list can be a document object, or a list of document objects'''
         self.modifyVPProperty(doc_obj_or_list, "Visibility", False)
     
+    def _dependent(self, doc_obj):
+        '''returns dependents of doc_obj: the memoized closure of DepGraphIndex if there is 
+        one, otherwise a lazy traversal. A lazy traversal is not memoized, so that a 
+        one-off hide doesn't build and keep a list of the whole model; callers that need 
+        the closure again (e.g. selection checks) fill the cache, and then it is reused here.'''
+        cached = getDepGraphIndex(doc_obj.Document).getCachedDependent(doc_obj)
+        return cached if cached is not None else iterDependent(doc_obj)
+
+    def _dependencies(self, doc_obj):
+        '''same as _dependent, for the other direction.'''
+        cached = getDepGraphIndex(doc_obj.Document).getCachedDependencies(doc_obj)
+        return cached if cached is not None else iterDependencies(doc_obj)
+
     def hide_all_dependent(self, doc_obj):
         '''hide_all_dependent(doc_obj): hides all objects that depend on doc_obj. Groups, Parts and Bodies are not hidden by this.'''
-        self.hide( [o for o in getAllDependent(doc_obj) if not isContainer(o)])
+        self._modifyMany(self._dependent(doc_obj), "Visibility", False, skip_containers= True)
                 
+    def isolate(self, doc_obj_or_list):
+        '''isolate(doc_obj_or_list): hides everything except the given objects (e.g. the 
+        feature being edited and its references) and the containers they are in. 
+        Containers that don't hold any of the given objects are hidden as a whole; 
+        objects are hidden one by one only inside the containers that do. So the 
+        number of changes depends on depth and fan-out of the container tree, rather 
+        than on the number of objects in the document.
+        
+        Group view providers (and Parts and Bodies, which inherit from them) pass hiding 
+        and showing on to their contents. So visibilities of everything inside the 
+        containers that are shown or hidden here are recorded beforehand (read, not 
+        written), outer containers first, and restore() puts them back after the 
+        containers.'''
+        if type(doc_obj_or_list) is not list:
+            doc_obj_or_list = [doc_obj_or_list]
+        keep = set([o.Name for o in doc_obj_or_list])
+        path = OrderedDict() # containers (except document) holding objects to keep, outermost first. key = Name, value = container.
+        for o in doc_obj_or_list:
+            for cnt in getContainerChain(o)[1:]:
+                path[cnt.Name] = cnt
+        to_hide = []
+        for cnt in [self.document] + list(path.values()):
+            if cnt is not self.document and cnt.Name in keep:
+                continue #kept containers are shown with all their contents
+            for child in getContainerContents(cnt):
+                if not (child.Name in keep or child.Name in path):
+                    to_hide.append(child)
+        cascading = list(path.values()) + [o for o in doc_obj_or_list + to_hide if isContainer(o)]
+        self._record(_iterSubtrees(cascading), "Visibility")
+        with self.batch():
+            self.show(doc_obj_or_list)
+            self.show(list(path.values()))
+            self.hide(to_hide)
+
     def show_all_dependent(self, doc_obj):
         '''show_all_dependent(doc_obj): shows all objects that depend on doc_obj. This method is probably useless.'''
-        self.show( getAllDependent(doc_obj) )
+        self._modifyMany(self._dependent(doc_obj), "Visibility", True)
 
     def hide_all_dependencies(self, doc_obj):
         '''hide_all_dependencies(doc_obj): hides all objects that doc_obj depends on (directly and indirectly).'''
-        self.hide( getAllDependencies(doc_obj) )
+        self._modifyMany(self._dependencies(doc_obj), "Visibility", False)
                 
     def show_all_dependencies(self, doc_obj):
         '''show_all_dependencies(doc_obj): shows all objects that doc_obj depends on (directly and indirectly). This method is probably useless.'''
-        self.show( getAllDependencies(doc_obj) )
+        self._modifyMany(self._dependencies(doc_obj), "Visibility", True)
             
     def restore(self):
         '''restore(): restore all ViewProvider properties modified via TempoVis to their original values. Called automatically when instance is destroyed, unless it was called explicitly.'''
-        for obj_name, prop_name in self.data:
-            setattr(self.document.getObject(obj_name).ViewObject, prop_name, self.data[(obj_name, prop_name)])
+        for (i, prop_name) in sorted(self.changed):
+            oldval = self.originals[prop_name][i]
+            try:
+                vp = self.objects[i].ViewObject
+                curval = getattr(vp, prop_name)
+            except Exception:
+                continue #object was deleted while editing
+            if curval != oldval:
+                setattr(vp, prop_name, oldval)
+        self.changed = set()
         self.restore_on_delete = False
     
     def forget(self):
         '''forget(): resets TempoVis'''
-        self.data = {}
+        self.objects = []
+        self.obj_index = {}
+        self.originals = {}
+        self.changed = set()
+        self.pending = OrderedDict()
         self.restore_on_delete = False        
         
     def __del__(self):
         if self.restore_on_delete:
             self.restore()
     
-    
\ No newline at end of file
+    